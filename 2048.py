@@ -9,16 +9,35 @@
 
 
 from __future__ import print_function
-from line_profiler import LineProfiler
 
 import time
-import os
-import searchai    #for task 3
-import heuristicai #for task 2
+START_TIME = time.time()
 
+import os
 from statistics import median
 
+# numpy, numba and the engines are imported when they are needed, a run only pays for its mode
+
 PROFILE_MODE = False
+# TraceWriter which records every turn, see --trace
+TRACE = None
+# 'search' (searchai, for task 3) or 'heuristic' (heuristicai, for task 2), see --engine
+ENGINE = 'search'
+
+# (phase, seconds) from the start of the program to the first move, shown with -v
+STARTUP = []
+_last_phase = START_TIME
+
+def startup_phase(name):
+    ''' End a phase of the startup, it took the time since the last one. '''
+    global _last_phase
+    now = time.time()
+    STARTUP.append((name, now - _last_phase))
+    _last_phase = now
+
+def startup_report():
+    return "Startup: %s, total %.2fs" % (', '.join('%s %.2fs' % phase for phase in STARTUP),
+                                          sum(seconds for _, seconds in STARTUP))
 
 def print_board(m):
     for row in m:
@@ -41,64 +60,142 @@ def _to_score(c):
 def to_score(m):
     return [[_to_score(c) for c in row] for row in m]
 
-def find_best_move(board):
-    #return heuristicai.find_best_move(board)
+def find_best_move(board, new_turn=True):
+    if ENGINE == 'heuristic':
+        import heuristicai
+        return heuristicai.find_best_move(board)
+    if ENGINE == 'rollout':
+        import rolloutai
+        return rolloutai.find_best_move(board)
 
+    import searchai
     if PROFILE_MODE:
+        from line_profiler import LineProfiler
         lp = LineProfiler()
         lp.add_function(searchai.execute_move)
         lp.add_function(searchai.score_max_node)
         lp_wrapper = lp(searchai.find_best_move)
-        move = lp_wrapper(board)
+        move = lp_wrapper(board, new_turn=new_turn)
         lp.print_stats()
     else:
-        move = searchai.find_best_move(board)
+        move = searchai.find_best_move(board, new_turn=new_turn)
 
     return move
 
 def movename(move):
     return ['up', 'down', 'left', 'right'][move]
 
-def start_game(gamectrl, iterations=1, verbose=0):
+def start_game(gamectrl, iterations=1, verbose=0, workers=1, split_chance_nodes=False, pipeline=False):
     highest_score = 0
     highest_maxval = 0
     scores = []
-    for i in range(iterations):
-        gamectrl.restart_game()
-        score, maxval = play_game(gamectrl, verbose)
-        highest_maxval = max(highest_maxval, maxval)
-        highest_score = max(highest_score, score)
-        scores.append(score)
+    if ENGINE == 'search':
+        import searchai
+        searchai.start_pool(workers, split_chance_nodes)
+        loaded, compiled = searchai.check_compiled()
+        startup_phase('warmup (%d functions loaded, %d compiled)' % (loaded, compiled))
+    elif ENGINE == 'rollout':
+        import rolloutai
+        rolloutai.start_pool(workers)
+        startup_phase('warmup')
+    try:
+        for i in range(iterations):
+            gamectrl.restart_game()
+            score, maxval = play_game(gamectrl, verbose, pipeline)
+            highest_maxval = max(highest_maxval, maxval)
+            highest_score = max(highest_score, score)
+            scores.append(score)
+    finally:
+        if ENGINE == 'search':
+            searchai.stop_pool()
+        elif ENGINE == 'rollout':
+            rolloutai.stop_pool()
 
     average = sum(scores) / iterations
     print("Games: %d, highest score: %d, median: %d, average: %d, highest tile: %d" % (iterations, highest_score, median(scores), average, highest_maxval))
 
-def play_game(gamectrl, verbose):
+def play_game(gamectrl, verbose, pipeline=False):
+    import bitboard
+    from searchstats import SearchStats
+
     moveno = 0
-    while 1:
-        state = gamectrl.get_status()
-        if state == 'ended':
-            break
-        elif state == 'won':
-            time.sleep(0.75)
-            gamectrl.continue_game()
-
-        moveno += 1
-        board = gamectrl.get_board()
-        start = time.time()
-        move = find_best_move(board)
-        if move < 0:
-            break
-        if verbose >= 1:
-            print("Execution time: %010.6fs" % (time.time() - start))
-            print("Score %d, Move %d: %s" % (gamectrl.get_score(), moveno, movename(move)))
-        gamectrl.execute_move(move)
+    speculator = None
+    # SearchStats of every move, the move cache is filled from them
+    searches = []
+    turns = []
+    fill_move_cache = False
+    if ENGINE == 'search':
+        import searchai
+        if pipeline:
+            from speculation import Speculator
+            speculator = Speculator()
+        fill_move_cache = searchai.MOVE_CACHE is not None and searchai.MOVE_CACHE.writable
+        searchai.STATS_HOOK = searches.append
+    try:
+        while 1:
+            # status, score and board are read at once, the browser is slow to ask
+            snapshot = gamectrl.get_snapshot()
+            if snapshot.status == 'ended':
+                break
+            elif snapshot.status == 'won':
+                gamectrl.continue_game()
+
+            moveno += 1
+            board = bitboard.to_board(snapshot.board)
+            start = time.time()
+            move = None
+            if speculator is not None:
+                move = speculator.get_move(snapshot.board)
+            if move is None:
+                # the speculator started the turn already
+                move = find_best_move(board, new_turn=speculator is None or moveno == 1)
+            if move < 0:
+                break
+            # the heuristic doesn't search
+            search = searches[-1] if searches else SearchStats()
+            if fill_move_cache:
+                turns.append((snapshot.board, move, search.value, search.depth))
+            if TRACE is not None:
+                TRACE.add_turn(snapshot.board, move, snapshot.score, search.depth,
+                               (time.time() - start) * 1000, search.value)
+            if moveno == 1:
+                startup_phase('first move')
+                if verbose >= 1:
+                    print(startup_report())
+            if verbose >= 1:
+                print("Execution time: %010.6fs" % (time.time() - start))
+                print("Score %d, Move %d: %s" % (snapshot.score, moveno, movename(move)))
+            if speculator is not None:
+                # search the next turn while the browser moves
+                speculator.start(snapshot.board, move)
+            gamectrl.execute_move(move)
+    finally:
+        if speculator is not None:
+            speculator.cancel()
+        if ENGINE == 'search':
+            searchai.STATS_HOOK = None
+        if TRACE is not None:
+            TRACE.end_game()
+
+    game_stats = SearchStats()
+    for stats in searches:
+        game_stats.add(stats)
+    if fill_move_cache:
+        searchai.MOVE_CACHE.add_game(turns)
+        searchai.MOVE_CACHE.flush()
 
-    score = gamectrl.get_score()
-    board = gamectrl.get_board()
-    maxval = max(max(row) for row in to_val(board))
+    snapshot = gamectrl.get_snapshot()
+    score = snapshot.score
+    maxval = int(bitboard.to_board(snapshot.board).max())
     if verbose >= 1:
         print("Game over. Final score %d; highest tile %d." % (score, maxval))
+    if ENGINE == 'search':
+        if verbose >= 1:
+            print(searchai.TABLE)
+        if verbose >= 1 or searchai.COLLECT_STATS or searchai.VERIFY_PRUNING:
+            print(game_stats)
+    if speculator is not None:
+        print(speculator)
     
     return score, maxval
 
@@ -107,18 +204,42 @@ def parse_args(argv):
 
     parser = argparse.ArgumentParser(description="Use the AI to play 2048 via browser control")
     parser.add_argument('-p', '--port', help="Port number to control on (default: 32000 for Firefox, 9222 for Chrome)", type=int)
-    parser.add_argument('-b', '--browser', help="Browser you're using. Only Firefox with the Remote Control extension, and Chrome with remote debugging, are supported right now.", default='firefox', choices=('firefox', 'chrome'))
+    parser.add_argument('-b', '--browser', help="Browser you're using. Only Firefox with the Remote Control extension, and Chrome with remote debugging, are supported right now. 'headless' plays without a browser.", default='firefox', choices=('firefox', 'chrome', 'headless'))
     parser.add_argument('-k', '--ctrlmode', help="Control mode to use. If the browser control doesn't seem to work, try changing this.", default='hybrid', choices=('keyboard', 'fast', 'hybrid'))
     parser.add_argument('-n', '--iterations', help="Number of games to play in a row.", default='1', type=int)
-    parser.add_argument('-v', '--verbose', help="Verbose Output. Show every move.", action='count')
+    parser.add_argument('-s', '--seed', help="Random seed of the headless game.", type=int)
+    parser.add_argument('-v', '--verbose', help="Verbose Output. Show every move.", action='count', default=0)
+    parser.add_argument('-e', '--engine', help="AI which plays: the expectimax search, the rules of heuristicai or the random games of rolloutai.", default='search', choices=('search', 'heuristic', 'rollout'))
+    parser.add_argument('--table-mb', help="Memory cap of the search's transposition table in megabytes (default: searchai.TABLE_MEMORY_MB).", type=int)
+    parser.add_argument('-w', '--workers', help="Number of worker processes for the search or the rollouts (default: 1, no pool).", default=1, type=int)
+    parser.add_argument('--split-chance-nodes', help="Give every chance node of the first level its own worker task instead of every move.", action="store_true")
+    parser.add_argument('--move-budget-ms', help="Time per move of the search in milliseconds. The search deepens until the time is up instead of using a fixed depth. The rollouts play games until it is up (default: rolloutai.MOVE_BUDGET_MS).", type=float)
+    parser.add_argument('--rollout-horizon', help="Moves of every random game of the rollouts, 0 plays until the game ends.", default=0, type=int)
+    parser.add_argument('--rollout-policy', help="Moves of the random games: any legal move or the one which scores the most points.", default='greedy', choices=('random', 'greedy'))
+    parser.add_argument('--probability-cutoff', help="Boards which the search reaches with a lower probability are evaluated without searching deeper (default: searchai.PROBABILITY_CUTOFF).", type=float)
+    parser.add_argument('--no-bound-pruning', help="Search every move fully instead of cutting moves which can't beat a better one.", action="store_true")
+    parser.add_argument('--verify-pruning', help="Search every board also without bound pruning and count the moves where the best move differs. They can only differ with a --probability-cutoff above 0.", action="store_true")
+    parser.add_argument('--weights', help="Tile weights of the search heuristic.", default='snake', choices=('corner', 'snake'))
+    parser.add_argument('--monotonicity', help="Weight of the monotonicity penalty of the search heuristic.", default=0, type=float)
+    parser.add_argument('--smoothness', help="Weight of the smoothness penalty of the search heuristic.", default=0, type=float)
+    parser.add_argument('--empty-weight', help="Bonus for every empty tile in the search heuristic.", default=0, type=float)
+    parser.add_argument('--move-cache', help="File with the best moves of earlier runs, which are used instead of searching.")
+    parser.add_argument('--fill-move-cache', help="Store the moves of every game in the --move-cache, it is created if it doesn't exist.", action="store_true")
+    parser.add_argument('--trace', help="Append every turn to this trace file.")
+    parser.add_argument('--tabs', help="Play games in this many chrome tabs or headless games at once, the workers search for all of them.", default=1, type=int)
+    parser.add_argument('--pipeline', help="Search the possible next boards while the browser executes a move.", action="store_true")
+    parser.add_argument('--stats', help="Count the nodes of the search and show them at the end of every game.", action="store_true")
     parser.add_argument('--profiler', help="Run the game with line_profiler enabled.", action="store_true")
-    return parser.parse_args(argv)
-
-def main(argv):
-    args = parse_args(argv)
-
-    verbose = args.verbose
+    args = parser.parse_args(argv)
+    if args.trace and args.tabs > 1:
+        parser.error("--trace records a single game, it can't be used with --tabs")
+    if args.fill_move_cache and not args.move_cache:
+        parser.error("--fill-move-cache needs the file of the --move-cache")
+    if args.tabs > 1 and (args.pipeline or args.split_chance_nodes):
+        parser.error("--pipeline and --split-chance-nodes can't be used with --tabs, the farm searches every move as one task")
+    return args
 
+def create_browser_control(args):
     if args.browser == 'firefox':
         from ffctrl import FirefoxRemoteControl
         if args.port is None:
@@ -130,6 +251,27 @@ def main(argv):
             args.port = 9222
         ctrl = ChromeDebuggerControl(args.port)
 
+    return create_game_control(ctrl, args)
+
+def create_farm_controls(args):
+    """
+    Game controls of the farm: the first --tabs pages of chrome or headless games
+    """
+    if args.browser == 'headless':
+        from headlessctrl import Headless2048Control
+        seed = args.seed
+        return [Headless2048Control(None if seed is None else seed + i) for i in range(args.tabs)]
+    elif args.browser == 'chrome':
+        from chromectrl import ChromeDebuggerControl
+        if args.port is None:
+            args.port = 9222
+        ctrls = ChromeDebuggerControl.attach_all(args.port)[:args.tabs]
+        if len(ctrls) < args.tabs:
+            print("Only %d tabs are open" % len(ctrls))
+        return [create_game_control(ctrl, args) for ctrl in ctrls]
+    raise ValueError("The farm needs chrome or the headless game, the Firefox extension controls a single tab.")
+
+def create_game_control(ctrl, args):
     if args.ctrlmode == 'keyboard':
         from gamectrl import Keyboard2048Control
         gamectrl = Keyboard2048Control(ctrl)
@@ -140,14 +282,88 @@ def main(argv):
         from gamectrl import Hybrid2048Control
         gamectrl = Hybrid2048Control(ctrl)
 
-    if gamectrl.get_status() == 'ended':
+    return gamectrl
+
+def setup_search(args):
+    import searchai
+
+    searchai.MOVE_BUDGET_MS = args.move_budget_ms
+    searchai.COLLECT_STATS = args.stats
+    if args.probability_cutoff is not None:
+        searchai.PROBABILITY_CUTOFF = args.probability_cutoff
+    searchai.BOUND_PRUNING = not args.no_bound_pruning
+    searchai.VERIFY_PRUNING = args.verify_pruning
+
+    if args.table_mb is not None and args.table_mb != searchai.TABLE_MEMORY_MB:
+        from transposition import TranspositionTable
+        searchai.TABLE = TranspositionTable(args.table_mb)
+
+    if (args.weights, args.monotonicity, args.smoothness, args.empty_weight) != ('snake', 0, 0, 0):
+        searchai.set_heuristic(args.weights, args.monotonicity, args.smoothness, args.empty_weight)
+
+    if args.move_cache:
+        from movecache import MoveCache
+        searchai.MOVE_CACHE = MoveCache.open(args.move_cache, args.fill_move_cache)
+
+def main(argv):
+    startup_phase('imports')
+    args = parse_args(argv)
+    startup_phase('arguments')
+
+    verbose = args.verbose
+
+    if args.tabs > 1 and args.engine != 'search':
+        raise ValueError("The farm plays with the search, the workers are shared by all tabs.")
+
+    if args.tabs > 1:
+        gamectrl = None
+    elif args.browser == 'headless':
+        from headlessctrl import Headless2048Control
+        gamectrl = Headless2048Control(args.seed)
+    else:
+        gamectrl = create_browser_control(args)
+
+    if gamectrl is not None and gamectrl.get_status() == 'ended':
         gamectrl.restart_game()
+    startup_phase('game control')
+
+    global ENGINE
+    ENGINE = args.engine
+    if ENGINE == 'search':
+        setup_search(args)
+    elif ENGINE == 'rollout':
+        import rolloutai
+        if args.move_budget_ms is not None:
+            rolloutai.MOVE_BUDGET_MS = args.move_budget_ms
+        rolloutai.HORIZON = args.rollout_horizon
+        rolloutai.POLICY = args.rollout_policy
+    else:
+        import heuristicai
+    startup_phase('engine')
 
     if args.profiler:
         global PROFILE_MODE
         PROFILE_MODE = True    
-        
-    start_game(gamectrl, args.iterations, args.verbose)
+
+    if args.trace:
+        global TRACE
+        from gametrace import TraceWriter
+        TRACE = TraceWriter(args.trace)
+
+    if args.tabs > 1:
+        from farm import GameFarm, SearchService
+        # fork the workers before the tabs are attached, see SearchService
+        service = SearchService(args.workers)
+        game_farm = GameFarm(create_farm_controls(args), args.iterations, verbose=args.verbose, service=service)
+        game_farm.run()
+        print(game_farm.report())
+        return
+
+    try:
+        start_game(gamectrl, args.iterations, args.verbose, args.workers, args.split_chance_nodes, args.pipeline)
+    finally:
+        if TRACE is not None:
+            TRACE.close()
 
 if __name__ == '__main__':
     import sys
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Author:      chrn
+# Description: Statistics of recorded games. Streams over any number of trace files in
+#              chunks, every statistic is a histogram or a short top list, so the memory
+#              doesn't grow with the number of games.
+
+from __future__ import print_function
+
+import json
+import numpy as np
+
+import bitboard
+import gametrace
+
+# phases by the largest tile on the board, like the benchmark
+PHASES = (('early', 0, 7), ('mid', 8, 9), ('late', 10, 15))
+REACH_TILES = (2048, 4096, 8192, 16384)
+
+SCORE_BIN = 64
+SCORE_BINS = 1 << 16 # scores up to 4 million
+# latency histogram from 1us to 100s with 100 bins per decade
+LATENCY_EDGES = np.logspace(-3, 5, 801)
+
+
+def max_ranks(boards):
+    ''' Largest log2 tile of every packed board. '''
+    result = np.zeros(len(boards), dtype=np.uint64)
+    for shift in range(0, 64, 4):
+        np.maximum(result, (boards >> np.uint64(shift)) & np.uint64(0xF), out=result)
+    return result.astype(np.int64)
+
+def histogram_percentiles(counts, edges, points=(50, 90, 99)):
+    ''' Percentiles from a histogram, the upper edge of the bin. '''
+    total = counts.sum()
+    if total == 0:
+        return {}
+    cumulative = np.cumsum(counts)
+    return dict(('p%d' % p, float(edges[np.searchsorted(cumulative, total * p / 100.0) + 1])) for p in points)
+
+
+class TraceAnalyzer(object):
+    ''' Collect the statistics of trace files chunk by chunk. '''
+
+    def __init__(self, top=10):
+        self.top = top
+        self.games = 0
+        self.moves = 0
+        self.max_tiles = np.zeros(16, dtype=np.int64)
+        self.scores = np.zeros(SCORE_BINS, dtype=np.int64)
+        self.score_sum = 0
+        self.latencies = dict((phase, np.zeros(len(LATENCY_EDGES) - 1, dtype=np.int64)) for phase, _, _ in PHASES)
+        # (change, path, game, turn, board, move, value, next value) of the largest value changes
+        self.changes = []
+
+    def add_file(self, path, chunk_records=1 << 20):
+        records = gametrace.read_trace(path)
+        for start in range(0, len(records), chunk_records):
+            # one more record to see if the last game of the chunk goes on
+            self.add_chunk(path, records[start:start + chunk_records + 1], start + chunk_records >= len(records))
+
+    def add_chunk(self, path, records, last_chunk):
+        n = len(records) if last_chunk else len(records) - 1
+        if n <= 0:
+            return
+        boards = records['board']
+        games = records['game']
+        ranks = max_ranks(boards[:n])
+        self.moves += n
+
+        for phase, low, high in PHASES:
+            in_phase = (ranks >= low) & (ranks <= high)
+            self.latencies[phase] += np.histogram(records['latency'][:n][in_phase], LATENCY_EDGES)[0]
+
+        # a game ends where the next record belongs to another game
+        same_game = games[:n] == np.append(games[1:n + 1], -1)[:n]
+        for i in np.flatnonzero(~same_game):
+            # the records hold the state before the move, add the last move
+            board = np.uint64(boards[i])
+            move = int(records['move'][i])
+            score = int(records['score'][i]) + int(bitboard.move_score(move, board))
+            self.max_tiles[max_ranks(np.array([bitboard.execute_move(move, board)], dtype=np.uint64))[0]] += 1
+            self.scores[min(score // SCORE_BIN, SCORE_BINS - 1)] += 1
+            self.score_sum += score
+            self.games += 1
+
+        self._add_changes(path, records, n, same_game)
+
+    def _add_changes(self, path, records, n, same_game):
+        values = records['value'][:n].astype(np.float64)
+        next_values = np.append(records['value'][1:n + 1], 0)[:n].astype(np.float64)
+        changes = np.where(same_game, np.abs(next_values - values), -1)
+        candidates = np.argpartition(-changes, min(self.top, n - 1))[:self.top]
+        for i in candidates:
+            if changes[i] < 0:
+                continue
+            record = records[i]
+            self.changes.append((float(changes[i]), path, int(record['game']), int(record['turn']),
+                                 '%016x' % int(record['board']), int(record['move']),
+                                 float(values[i]), float(next_values[i])))
+        self.changes = sorted(self.changes, reverse=True)[:self.top]
+
+    def result(self):
+        edges = np.arange(SCORE_BINS + 1) * SCORE_BIN
+        reached = np.cumsum(self.max_tiles[::-1])[::-1]
+        games = max(self.games, 1)
+        latency = {}
+        for phase, counts in self.latencies.items():
+            latency[phase] = histogram_percentiles(counts, LATENCY_EDGES)
+            latency[phase]['moves'] = int(counts.sum())
+        return {
+            'games': self.games,
+            'moves': self.moves,
+            'reach': dict((str(tile), float(reached[tile.bit_length() - 1]) / games) for tile in REACH_TILES),
+            'max_tile': dict((str(1 << rank), int(count)) for rank, count in enumerate(self.max_tiles) if count),
+            'score': dict(histogram_percentiles(self.scores, edges, (10, 25, 50, 75, 90)),
+                          mean=self.score_sum / float(games)),
+            'latency_ms': latency,
+            'value_changes': [dict(zip(('change', 'path', 'game', 'turn', 'board', 'move', 'value', 'next_value'), change))
+                              for change in self.changes],
+        }
+
+
+def print_result(result):
+    print("Games: %d, moves: %d" % (result['games'], result['moves']))
+    print("Reached: %s" % ', '.join('%s: %.1f%%' % (tile, result['reach'][str(tile)] * 100) for tile in REACH_TILES))
+    score = result['score']
+    print("Score: mean %d, %s" % (score['mean'], ', '.join('p%d %d' % (p, score['p%d' % p]) for p in (10, 25, 50, 75, 90) if 'p%d' % p in score)))
+    for phase, _, _ in PHASES:
+        latency = result['latency_ms'][phase]
+        if latency['moves']:
+            print("Latency %s: %d moves, p50 %.2fms, p90 %.2fms, p99 %.2fms" % (
+                phase, latency['moves'], latency['p50'], latency['p90'], latency['p99']))
+    print("Largest value changes:")
+    for change in result['value_changes']:
+        print("  %(path)s game %(game)d turn %(turn)d board %(board)s move %(move)d: %(value).0f -> %(next_value).0f" % change)
+
+def parse_args(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Statistics of recorded games")
+    parser.add_argument('traces', nargs='+', help="Trace files written by 2048.py --trace.")
+    parser.add_argument('-t', '--top', help="Number of the largest value changes to show.", default=10, type=int)
+    parser.add_argument('-o', '--output', help="Write the statistics to this JSON file.")
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+    analyzer = TraceAnalyzer(args.top)
+    for path in args.traces:
+        analyzer.add_file(path)
+    result = analyzer.result()
+    print_result(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    exit(main(sys.argv[1:]))
@@ -0,0 +1,306 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Author:      chrn
+# Description: Reproducible benchmark of the AIs. Searches a fixed corpus of early, mid and
+#              late game boards and plays seeded games without a browser. Results are
+#              written as JSON, two result files can be compared to find regressions.
+
+from __future__ import print_function
+
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from multiprocessing import get_context
+
+import numpy as np
+
+import bitboard
+import searchai
+import heuristicai
+import rolloutai
+from headlessctrl import Headless2048Control
+
+CORPUS_FILE = 'benchmark_corpus.json'
+CORPUS_VERSION = 1
+
+# seconds from the start of a new process to its first move, with a warm numba cache
+FIRST_MOVE_TARGET = 2.0
+
+# run by bench_startup in a new process
+STARTUP_SCRIPT = '''
+import json, sys, time
+start = time.time()
+import benchmark, bitboard, searchai
+find_best_move = benchmark.make_engine(sys.argv[1], None if sys.argv[2] == 'None' else int(sys.argv[2]))
+imported = time.time()
+find_best_move(bitboard.to_board(0x1000320001225433))
+done = time.time()
+loaded, compiled = searchai.check_compiled()
+print(json.dumps({'import_s': imported - start, 'first_move_s': done - start, 'loaded': loaded, 'compiled': compiled}))
+'''
+
+# the largest tile of a board decides its phase
+PHASES = (('early', 0, 7), ('mid', 8, 9), ('late', 10, 15))
+
+# metrics compared by compare_results and if a larger value is better
+METRICS = {
+    'startup.first_move_s': False,
+    'corpus.nodes_per_sec': True,
+    'corpus.latency_ms.p50': False,
+    'corpus.latency_ms.p99': False,
+    'games.moves_per_sec': True,
+    'games.latency_ms.p99': False,
+    'games.score.median': True,
+    'peak_rss_kb': False,
+}
+
+def percentiles(values, points=(50, 90, 99)):
+    if len(values) == 0:
+        return {}
+    return dict(('p%d' % p, float(np.percentile(values, p))) for p in points)
+
+def distribution(values):
+    values = np.asarray(values, dtype=np.float64)
+    return {'min': float(values.min()), 'p25': float(np.percentile(values, 25)),
+            'median': float(np.median(values)), 'p75': float(np.percentile(values, 75)),
+            'max': float(values.max()), 'mean': float(values.mean())}
+
+def search_nodes():
+    ''' Chance nodes searched so far, every one of them probes the transposition table. '''
+    return searchai.TABLE.hits + searchai.TABLE.misses
+
+def make_engine(engine, depth):
+    if engine == 'search':
+        return lambda board: searchai.find_best_move(board, depth)
+    elif engine == 'heuristic':
+        return heuristicai.find_best_move
+    elif engine == 'rollout':
+        return rolloutai.find_best_move
+    raise ValueError("Unknown engine: %s" % engine)
+
+def bench_startup(engine, depth):
+    ''' Time to the first move of a new process, the numba cache is expected to be warm. '''
+    # the script imports the modules of the repository, whatever the working directory of the caller
+    output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT, engine, str(depth)],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+def bench_corpus(find_best_move, corpus):
+    latencies = []
+    nodes = search_nodes()
+    start = time.time()
+    for phase, boards in sorted(corpus['boards'].items()):
+        for packed in boards:
+            board = bitboard.to_board(int(packed, 16))
+            move_start = time.time()
+            find_best_move(board)
+            latencies.append(time.time() - move_start)
+    elapsed = time.time() - start
+    nodes = search_nodes() - nodes
+
+    return {'moves': len(latencies), 'seconds': elapsed,
+            'nodes_per_sec': nodes / elapsed if elapsed > 0 else 0.0,
+            'latency_ms': percentiles(np.array(latencies) * 1000)}
+
+def bench_games(find_best_move, games, seed):
+    latencies = []
+    scores = []
+    max_tiles = {}
+    start = time.time()
+    for i in range(games):
+        gamectrl = Headless2048Control(seed + i)
+        while gamectrl.get_status() != 'ended':
+            if gamectrl.get_status() == 'won':
+                gamectrl.continue_game()
+            move_start = time.time()
+            move = find_best_move(gamectrl.get_board())
+            latencies.append(time.time() - move_start)
+            if move < 0:
+                break
+            gamectrl.execute_move(move)
+
+        scores.append(gamectrl.get_score())
+        max_tile = str(int(gamectrl.get_board().max()))
+        max_tiles[max_tile] = max_tiles.get(max_tile, 0) + 1
+    elapsed = time.time() - start
+
+    return {'games': games, 'moves': len(latencies), 'seconds': elapsed,
+            'moves_per_sec': len(latencies) / elapsed if elapsed > 0 else 0.0,
+            'latency_ms': percentiles(np.array(latencies) * 1000),
+            'score': distribution(scores), 'max_tile': max_tiles}
+
+def run_benchmark(engines, depths, games, seed, corpus):
+    results = {'corpus_version': corpus['version'], 'seed': seed, 'games': games,
+               'python': platform.python_version(), 'machine': platform.machine(), 'runs': {}}
+
+    for engine in engines:
+        for depth in (depths if engine == 'search' else [None]):
+            name = engine if depth is None else '%s:%d' % (engine, depth)
+            print("Benchmarking %s" % name)
+            # a new process for every run, the peak memory of a process never goes down
+            with get_context('spawn').Pool(1) as pool:
+                run = pool.apply(bench_run, ((engine, depth, games, seed, corpus),))
+            results['runs'][name] = run
+            print_run(name, run)
+
+    return results
+
+def bench_run(task):
+    ''' Benchmark one engine and depth. Returns the run of the results. '''
+    engine, depth, games, seed, corpus = task
+    find_best_move = make_engine(engine, depth)
+    # compile everything before measuring, this also fills the numba cache for bench_startup
+    searchai.warmup()
+    find_best_move(bitboard.to_board(int(corpus['boards']['early'][0], 16)))
+    searchai.TABLE.clear()
+
+    run = {'startup': bench_startup(engine, depth), 'corpus': bench_corpus(find_best_move, corpus)}
+    searchai.TABLE.clear()
+    if games > 0:
+        run['games'] = bench_games(find_best_move, games, seed)
+    run['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return run
+
+def print_run(name, run):
+    startup = run['startup']
+    print("  startup: first move after %.2fs (imports %.2fs), %d functions compiled%s" % (
+        startup['first_move_s'], startup['import_s'], startup['compiled'],
+        ", over the target of %.1fs" % FIRST_MOVE_TARGET if startup['first_move_s'] > FIRST_MOVE_TARGET else ""))
+    corpus = run['corpus']
+    print("  corpus: %d moves, %.0f nodes/s, latency p50 %.2fms p99 %.2fms" % (
+        corpus['moves'], corpus['nodes_per_sec'], corpus['latency_ms']['p50'], corpus['latency_ms']['p99']))
+    if 'games' in run:
+        games = run['games']
+        print("  games: %d, %.1f moves/s, median score %d, max tiles %s" % (
+            games['games'], games['moves_per_sec'], games['score']['median'],
+            ', '.join('%s: %d' % item for item in sorted(games['max_tile'].items(), key=lambda x: int(x[0])))))
+    print("  peak memory: %d kB" % run['peak_rss_kb'])
+
+def get_metric(run, metric):
+    value = run
+    for key in metric.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+def compare_results(base, new, tolerance):
+    """
+    Compare the runs which are in both results.
+    Returns: list of (run, metric, base value, new value, regression)
+    """
+    if base.get('corpus_version') != new.get('corpus_version'):
+        print("Warning: the results use different corpus versions")
+
+    rows = []
+    for name in sorted(set(base['runs']) & set(new['runs'])):
+        for metric, larger_is_better in sorted(METRICS.items()):
+            old_value = get_metric(base['runs'][name], metric)
+            new_value = get_metric(new['runs'][name], metric)
+            if old_value is None or new_value is None:
+                continue
+            if larger_is_better:
+                regression = new_value < old_value * (1 - tolerance)
+            else:
+                regression = new_value > old_value * (1 + tolerance)
+            rows.append((name, metric, old_value, new_value, regression))
+    return rows
+
+def make_corpus(games, seed, per_phase):
+    """
+    Collect boards of every phase from seeded games of the search AI
+    """
+    boards = dict((phase, []) for phase, _, _ in PHASES)
+    for i in range(games):
+        gamectrl = Headless2048Control(seed + i)
+        while gamectrl.get_status() != 'ended':
+            if gamectrl.get_status() == 'won':
+                gamectrl.continue_game()
+            board = gamectrl.get_board()
+            max_rank = int(board.max()).bit_length() - 1
+            for phase, low, high in PHASES:
+                if low <= max_rank <= high:
+                    boards[phase].append('%016x' % bitboard.to_bitboard(board))
+            gamectrl.execute_move(searchai.find_best_move(board))
+        print("Game %d: score %d" % (i + 1, gamectrl.get_score()))
+
+    # take the boards evenly spread over all games
+    rng = np.random.RandomState(seed)
+    for phase in boards:
+        if len(boards[phase]) > per_phase:
+            picked = sorted(rng.choice(len(boards[phase]), per_phase, replace=False))
+            boards[phase] = [boards[phase][i] for i in picked]
+    return {'version': CORPUS_VERSION, 'seed': seed, 'games': games, 'boards': boards}
+
+def parse_args(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the 2048 AIs without a browser")
+    commands = parser.add_subparsers(dest='command')
+
+    run = commands.add_parser('run', help="Run the benchmark")
+    run.add_argument('-o', '--output', help="Write the results to this JSON file.")
+    run.add_argument('-e', '--engines', help="Comma separated engines: search, heuristic, rollout.", default='search')
+    run.add_argument('-d', '--depths', help="Comma separated search depths.", default='3,4,5')
+    run.add_argument('-n', '--games', help="Number of seeded games for every engine and depth.", default=3, type=int)
+    run.add_argument('-s', '--seed', help="Seed of the first game.", default=0, type=int)
+    run.add_argument('-c', '--corpus', help="Board corpus (default: %s)." % CORPUS_FILE, default=CORPUS_FILE)
+
+    compare = commands.add_parser('compare', help="Compare two result files and flag regressions")
+    compare.add_argument('base', help="Results before the change.")
+    compare.add_argument('new', help="Results after the change.")
+    compare.add_argument('-t', '--tolerance', help="Allowed relative change (default: 0.1).", default=0.1, type=float)
+
+    corpus = commands.add_parser('corpus', help="Create a new board corpus")
+    corpus.add_argument('-o', '--output', default=CORPUS_FILE)
+    corpus.add_argument('-n', '--games', help="Number of games to collect boards from.", default=5, type=int)
+    corpus.add_argument('-p', '--per-phase', help="Boards of every phase.", default=20, type=int)
+    corpus.add_argument('-s', '--seed', default=0, type=int)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error("choose a command: run, compare or corpus")
+    return args
+
+def main(argv):
+    args = parse_args(argv)
+
+    if args.command == 'run':
+        with open(args.corpus) as f:
+            corpus = json.load(f)
+        engines = args.engines.split(',')
+        depths = [int(d) for d in args.depths.split(',')]
+        results = run_benchmark(engines, depths, args.games, args.seed, corpus)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+    elif args.command == 'compare':
+        with open(args.base) as f:
+            base = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        rows = compare_results(base, new, args.tolerance)
+        for name, metric, old_value, new_value, regression in rows:
+            change = (new_value - old_value) / old_value * 100 if old_value else 0.0
+            print("%-12s %-24s %14.2f %14.2f %+8.1f%% %s" % (
+                name, metric, old_value, new_value, change, 'REGRESSION' if regression else ''))
+        if any(row[4] for row in rows):
+            return 1
+
+    elif args.command == 'corpus':
+        corpus = make_corpus(args.games, args.seed, args.per_phase)
+        with open(args.output, 'w') as f:
+            json.dump(corpus, f, indent=1, sort_keys=True)
+        print("Wrote %s" % ', '.join('%d %s' % (len(b), p) for p, b in sorted(corpus['boards'].items())))
+
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    exit(main(sys.argv[1:]))
@@ -0,0 +1,166 @@
+# -*- coding: UTF-8 -*-
+import numpy as np
+from numba import njit
+
+from util import UP, DOWN, LEFT, RIGHT
+
+# Author:      chrn (original by nneonneo)
+# Copyright:   https://github.com/nneonneo/2048-ai
+# Description: 64 bit board representation used by the search. Every tile is stored
+#              as a 4 bit log2 value (0 = empty, 1 = 2, 2 = 4, ...), row by row starting
+#              at the lowest nibble. Moves are done with precomputed row tables.
+
+ROW_MASK = np.uint64(0xFFFF)
+
+
+def _build_row_tables():
+    """
+    Precompute the result of a left and a right move for all 65536 possible rows.
+    All rows are merged at once, one step for every tile.
+    """
+    rows = np.arange(65536, dtype=np.int64)
+    ranks = (rows[:, np.newaxis] >> (4 * np.arange(4))) & 0xF
+    # slide the tiles to the left, the empty ones to the end
+    tiles = np.take_along_axis(ranks, np.argsort(ranks == 0, axis=1, kind='stable'), axis=1)
+    tiles = np.hstack([tiles, np.zeros((65536, 1), dtype=np.int64)])
+
+    merged = np.zeros((65536, 4), dtype=np.int64)
+    row_score = np.zeros(65536, dtype=np.uint32)
+    i = np.zeros(65536, dtype=np.int64)    # next tile of every row
+    n = np.zeros(65536, dtype=np.int64)    # merged tiles of every row
+    for _ in range(4):
+        tile = tiles[rows, np.minimum(i, 4)]
+        following = tiles[rows, np.minimum(i + 1, 4)]
+        active = tile != 0
+        merge = active & (tile == following)
+        # tiles are capped at 2^15, the largest value a nibble can hold
+        merged[rows[active], n[active]] = np.where(merge, np.minimum(tile + 1, 15), tile)[active]
+        row_score += np.where(merge, 1 << (tile + 1), 0).astype(np.uint32)
+        n += active
+        i += np.where(merge, 2, active)
+
+    row_left = (merged[:, 0] | (merged[:, 1] << 4) | (merged[:, 2] << 8) | (merged[:, 3] << 12)).astype(np.uint16)
+    # a right move is a left move on the mirrored row
+    row_right = np.zeros(65536, dtype=np.uint16)
+    row_right[reverse_row(rows)] = reverse_row(row_left.astype(np.int64))
+
+    return row_left, row_right, row_score
+
+def reverse_row(row):
+    """
+    Mirror a 16 bit row
+    >>> hex(reverse_row(0x4321))
+    '0x1234'
+    """
+    return ((row >> 12) | ((row >> 4) & 0x00F0) | ((row << 4) & 0x0F00) | (row << 12)) & 0xFFFF
+
+# a row merges the same pairs in both directions, so one score table is enough
+ROW_LEFT_TABLE, ROW_RIGHT_TABLE, ROW_SCORE_TABLE = _build_row_tables()
+
+
+def to_bitboard(board):
+    """
+    Pack a two dimensional board with the real tile values into a 64 bit integer
+    >>> hex(to_bitboard([[2, 4, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 2048]]))
+    '0xb000000000000021'
+    """
+    bitboard = 0
+    for i, value in enumerate(np.asarray(board).flatten()):
+        value = int(value)
+        if value > 0:
+            bitboard |= min(value.bit_length() - 1, 15) << (4 * i)
+    return bitboard
+
+def to_board(bitboard):
+    """
+    Unpack a 64 bit board into a two dimensional array with the real tile values
+    >>> to_board(0xb000000000000021).tolist()
+    [[2, 4, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 2048]]
+    """
+    bitboard = int(bitboard)
+    board = np.zeros((4, 4), dtype=np.uint32)
+    for i in range(16):
+        rank = (bitboard >> (4 * i)) & 0xF
+        if rank > 0:
+            board[i // 4][i % 4] = 1 << rank
+    return board
+
+
+@njit(cache=True)
+def transpose(board):
+    """
+    Swap rows and columns of the board
+    """
+    a1 = board & np.uint64(0xF0F00F0FF0F00F0F)
+    a2 = board & np.uint64(0x0000F0F00000F0F0)
+    a3 = board & np.uint64(0x0F0F00000F0F0000)
+    a = a1 | (a2 << np.uint64(12)) | (a3 >> np.uint64(12))
+    b1 = a & np.uint64(0xFF00FF0000FF00FF)
+    b2 = a & np.uint64(0x00FF00FF00000000)
+    b3 = a & np.uint64(0x00000000FF00FF00)
+    return b1 | (b2 >> np.uint64(24)) | (b3 << np.uint64(24))
+
+@njit(cache=True)
+def get_row(board, i):
+    return (board >> np.uint64(16 * i)) & ROW_MASK
+
+@njit(cache=True)
+def _move_rows(board, table):
+    result = np.uint64(0)
+    for i in range(4):
+        row = get_row(board, i)
+        result |= np.uint64(table[row]) << np.uint64(16 * i)
+    return result
+
+@njit(cache=True)
+def execute_move(move, board):
+    """
+    move and return the board without a new random tile.
+    Up and down are done as left and right on the transposed board.
+    """
+    if move == LEFT:
+        return _move_rows(board, ROW_LEFT_TABLE)
+    elif move == RIGHT:
+        return _move_rows(board, ROW_RIGHT_TABLE)
+    elif move == UP:
+        return transpose(_move_rows(transpose(board), ROW_LEFT_TABLE))
+    else:
+        return transpose(_move_rows(transpose(board), ROW_RIGHT_TABLE))
+
+@njit(cache=True)
+def move_score(move, board):
+    """
+    Return the points a move scores, the sum of all merged tiles
+    """
+    if move == UP or move == DOWN:
+        board = transpose(board)
+    score = 0
+    for i in range(4):
+        score += ROW_SCORE_TABLE[get_row(board, i)]
+    return score
+
+@njit(cache=True)
+def count_empty_tiles(board):
+    """
+    Count the nibbles which are zero
+    """
+    empty_tiles = 0
+    for i in range(16):
+        if (board >> np.uint64(4 * i)) & np.uint64(0xF) == 0:
+            empty_tiles += 1
+    return empty_tiles
+
+@njit(cache=True)
+def get_tile(board, pos):
+    """
+    Return the log2 value of the tile at position pos (0-15, row by row)
+    """
+    return (board >> np.uint64(4 * pos)) & np.uint64(0xF)
+
+@njit(cache=True)
+def set_tile(board, pos, rank):
+    """
+    Return a new board with the tile at position pos set to the log2 value rank
+    """
+    shift = np.uint64(4 * pos)
+    return (board & ~(np.uint64(0xF) << shift)) | (np.uint64(rank) << shift)
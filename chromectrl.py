@@ -1,99 +1,175 @@
-import urllib, urllib2, json, threading, itertools
+import json
+import asyncio
+import itertools
+import threading
+import urllib.request
 
 try:
-    import websocket
+    import websockets
 except ImportError:
-    websocket = None
+    websockets = None
 
-class ChromeDebuggerControl(object):
-    ''' Control Chrome using the debugging socket.
-    Chrome must be launched using the --remote-debugging-port=<port> option for this to work! '''
+# Author:      chrn (original by nneonneo)
+# Description: Handles the communication with the chrome browser over the DevTools protocol.
+#              All tabs share one asyncio event loop which runs in a background thread,
+#              commands are pipelined so many of them can be in flight at once.
 
-    def __init__(self, port):
-        if websocket is None:
-            raise NotImplementedError("websocket-client library not available; cannot control Chrome.\n"
-                                      "Please install it (pip install websocket-client) then try again.")
+class DevToolsError(Exception):
+    pass
 
-        # Obtain the list of pages
-        pages = json.loads(urllib2.urlopen('http://localhost:%d/json/list' % port).read())
-        if len(pages) == 0:
-            raise Exception("No pages to attach to!")
-        elif len(pages) == 1:
-            page = pages[0]
-        else:
-            print("Select a page to attach to:")
-            for i, page in enumerate(pages):
-                print("%d) %s" % (i+1, page['title'].encode('unicode_escape')))
-            while 1:
-                try:
-                    pageidx = int(raw_input("Selection? "))
-                    page = pages[pageidx-1]
-                    break
-                except Exception, e:
-                    print("Invalid selection:", e)
-
-        # Configure debugging websocket
-        wsurl = page['webSocketDebuggerUrl']
-        self.ws = websocket.create_connection(wsurl)
-
-        self.requests = {} # dictionary containing in-flight requests
-        self.results = {}
-        self.req_counter = itertools.count(1)
-
-        self.thread = threading.Thread(target=self._receive_thread)
-        self.thread.daemon = True
-        self.thread.start()
 
-        self._send_cmd_noresult('Runtime.enable')
+def list_pages(port, host='localhost'):
+    ''' Pages of a Chrome launched with --remote-debugging-port=<port> '''
+    with urllib.request.urlopen('http://%s:%d/json/list' % (host, port)) as f:
+        return [page for page in json.loads(f.read().decode('utf8')) if page.get('type', 'page') == 'page']
+
+
+class DevToolsClient(object):
+    ''' Asynchronous client for one DevTools websocket, e.g. one tab.
+
+    Every command gets an id and a future which is resolved by the reader task,
+    so send() can be awaited by many callers at the same time. '''
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.pending = {} # futures of the in-flight commands by id
+        self.ids = itertools.count(1)
+        self.on_event = None # called with every event message, e.g. Runtime.consoleAPICalled
+        self.reader = asyncio.ensure_future(self._read())
+
+    @classmethod
+    async def connect(cls, url):
+        if websockets is None:
+            raise NotImplementedError("websockets library not available; cannot control Chrome.\n"
+                                      "Please install it (pip install websockets) then try again.")
+        # results of JSON.stringify(grid) and similar can be large
+        ws = await websockets.connect(url, max_size=None)
+        client = cls(ws)
+        await client.send('Runtime.enable')
+        return client
 
-    def _receive_thread(self):
+    async def _read(self):
         ''' Continually read events and command results '''
-        while 1:
-            try:
-                message = json.loads(self.ws.recv())
-                if 'id' in message:
-                    id = message['id']
-                    event = self.requests.pop(id, None)
-                    if event is not None:
-                        self.results[id] = message
-                        event.set()
-            except Exception as e:
-                break
+        error = DevToolsError("Connection closed")
+        try:
+            async for data in self.ws:
+                message = json.loads(data)
+                if 'id' not in message:
+                    if self.on_event is not None:
+                        self.on_event(message)
+                    continue
+                future = self.pending.pop(message['id'], None)
+                if future is None or future.done():
+                    continue
+                if 'error' in message:
+                    future.set_exception(DevToolsError("%s (%d)" % (message['error']['message'], message['error']['code'])))
+                else:
+                    future.set_result(message.get('result', {}))
+        except Exception as e:
+            error = DevToolsError("Connection lost: %s" % e)
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self.pending.clear()
 
-    def _send_cmd_noresult(self, method, **params):
-        ''' Send a command and ignore the result. '''
-        id = next(self.req_counter)
+    async def send(self, method, **params):
+        ''' Send a command and wait for its result. '''
+        if self.reader.done():
+            raise DevToolsError("Connection closed")
+        id = next(self.ids)
         out = {'id': id, 'method': method}
         if params:
             out['params'] = params
-        self.ws.send(json.dumps(out))
 
-    def _send_cmd(self, method, **params):
-        ''' Send a command and wait for the result to be available. '''
-        id = next(self.req_counter)
-        out = {'id': id, 'method': method}
-        if params:
-            out['params'] = params
+        future = asyncio.get_running_loop().create_future()
+        self.pending[id] = future
+        await self.ws.send(json.dumps(out))
+        return await future
 
-        # Receive thread will signal us when the response is available
-        event = threading.Event()
-        self.requests[id] = event
-        self.ws.send(json.dumps(out))
-        event.wait()
+    async def evaluate(self, cmd):
+        ''' Evaluate javascript in the page and return the value of the last expression. '''
+        resp = await self.send('Runtime.evaluate', expression=cmd, returnByValue=True)
+        if 'exceptionDetails' in resp:
+            details = resp['exceptionDetails']
+            raise DevToolsError("JS evaluation threw an error: %s" % details.get('exception', {}).get('description', details.get('text')))
+        return resp['result'].get('value')
 
-        resp = self.results.pop(id)
-        if 'error' in resp:
-            raise Exception("Command %s(%s) failed: %s (%d)" % (
-                method, ', '.join('%s=%r' % (k,v) for k,v in params.iteritems()), resp['error']['message'], resp['error']['code']))
-        return resp['result']
+    async def close(self):
+        await self.ws.close()
+        await self.reader
+
+
+class EventLoopThread(object):
+    ''' An asyncio event loop running in a daemon thread. '''
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, coro):
+        ''' Schedule a coroutine on the loop. Returns a concurrent.futures.Future. '''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        return self.submit(coro).result()
+
+_LOOP = None
+
+def get_loop():
+    ''' The loop shared by all ChromeDebuggerControls of the process. '''
+    global _LOOP
+    if _LOOP is None:
+        _LOOP = EventLoopThread()
+    return _LOOP
+
+
+class ChromeDebuggerControl(object):
+    ''' Control Chrome using the debugging socket.
+    Chrome must be launched using the --remote-debugging-port=<port> option for this to work!
+
+    This is a blocking wrapper around DevToolsClient for gamectrl. Use submit() to
+    send several commands without waiting for each of them. '''
+
+    def __init__(self, port=9222, page=None, url=None, host='localhost'):
+        if url is None:
+            if page is None:
+                page = self.select_page(list_pages(port, host))
+            url = page['webSocketDebuggerUrl']
+
+        self.loop = get_loop()
+        self.client = self.loop.run(DevToolsClient.connect(url))
+
+    @classmethod
+    def attach_all(cls, port=9222, host='localhost'):
+        ''' Control every open page, e.g. one game in every tab. '''
+        return [cls(port, page, host=host) for page in list_pages(port, host)]
+
+    @staticmethod
+    def select_page(pages):
+        if len(pages) == 0:
+            raise Exception("No pages to attach to!")
+        elif len(pages) == 1:
+            return pages[0]
+
+        print("Select a page to attach to:")
+        for i, page in enumerate(pages):
+            print("%d) %s" % (i+1, page['title']))
+        while 1:
+            try:
+                pageidx = int(input("Selection? "))
+                return pages[pageidx-1]
+            except Exception as e:
+                print("Invalid selection:", e)
+
+    def submit(self, cmd):
+        ''' Evaluate javascript without waiting. Returns a concurrent.futures.Future. '''
+        return self.loop.submit(self.client.evaluate(cmd))
 
     def execute(self, cmd):
-        resp = self._send_cmd('Runtime.evaluate', expression=cmd)
-        #if resp['wasThrown']:
-        #    raise Exception("JS evaluation threw an error: %s" % resp['result']['description'])
-        result = resp['result']
-        if 'value' in result:
-            return result['value']
-        if 'description' in result:
-            return result['description']
-        return None
+        return self.submit(cmd).result()
+
+    def close(self):
+        self.loop.run(self.client.close())
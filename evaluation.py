@@ -0,0 +1,147 @@
+# -*- coding: UTF-8 -*-
+import numpy as np
+from numba import njit
+
+import bitboard
+import symmetry
+
+# Author:      chrn
+# Description: Table driven board evaluation for the search. The score of every possible
+#              row and column is precomputed, so evaluating a leaf costs 4 row and
+#              4 column lookups instead of a loop over all tiles.
+
+# fields of the row tables
+TILE_SCORE, EMPTY_TILES, LINE_SCORE = range(3)
+
+# index of the transforms which don't change the evaluation in the tables
+SYMMETRIES = 2
+# index of the tile weights sorted from the largest and of the largest line score, see upper_bound()
+SORTED_WEIGHTS, MAX_LINE_SCORE = 3, 4
+
+# exponent used to weight big tiles in the monotonicity term
+MONOTONICITY_POWER = 4
+
+
+def build_tables(tile_weights, monotonicity_weight=0, smoothness_weight=0, empty_weight=0):
+    """
+    Precompute the evaluation of all 65536 rows.
+    Args:
+        tile_weights (list) 4x4 weights of the squared tile values
+        monotonicity_weight, smoothness_weight (float) penalty for rows and columns
+            which are not sorted and for neighbouring tiles with different values
+        empty_weight (float) bonus for every empty tile
+    Returns: tuple (row tables (4, 65536, 3), column table (65536,),
+                    symmetries of the evaluation, see symmetry.stabilizer(),
+                    sorted tile weights (16,), largest score of 4 rows and 4 columns)
+    """
+    tile_weights = np.asarray(tile_weights, dtype=np.float64).reshape(4, 4)
+
+    rows = np.arange(65536, dtype=np.int64)
+    ranks = (rows[:, np.newaxis] >> (4 * np.arange(4))) & 0xF
+    values = np.where(ranks > 0, 2.0 ** ranks, 0)
+
+    # monotonicity: the smaller of the increases and decreases along the line
+    power = ranks.astype(np.float64) ** MONOTONICITY_POWER
+    diff = power[:, 1:] - power[:, :-1]
+    decreasing = np.where(ranks[:, :-1] > ranks[:, 1:], -diff, 0).sum(axis=1)
+    increasing = np.where(ranks[:, :-1] > ranks[:, 1:], 0, diff).sum(axis=1)
+    monotonicity = np.minimum(decreasing, increasing)
+
+    # smoothness: the rank differences of neighbouring tiles
+    neighbours = (ranks[:, :-1] > 0) & (ranks[:, 1:] > 0)
+    smoothness = np.where(neighbours, np.abs(ranks[:, :-1] - ranks[:, 1:]), 0).sum(axis=1)
+
+    empty = (ranks == 0).sum(axis=1)
+    line_score = -(monotonicity_weight * monotonicity + smoothness_weight * smoothness)
+
+    row_tables = np.zeros((4, 65536, 3), dtype=np.float64)
+    for i in range(4):
+        row_tables[i, :, TILE_SCORE] = (values ** 2 * tile_weights[i]).sum(axis=1)
+        row_tables[i, :, EMPTY_TILES] = empty
+        # the empty tiles are only counted once, on the rows
+        row_tables[i, :, LINE_SCORE] = line_score + empty_weight * empty
+    col_table = line_score.astype(np.float64)
+
+    max_line_score = max(4 * row_tables[0, :, LINE_SCORE].max() + 4 * col_table.max(), 0.0)
+    return (row_tables, col_table, symmetry.stabilizer(tile_weights),
+            np.sort(tile_weights.ravel())[::-1].copy(), float(max_line_score))
+
+@njit(cache=True)
+def evaluate(board, heuristic):
+    """
+    Evaluate the board with tables from build_tables(). The weighted tile score
+    is multiplied with the number of empty tiles, the row and column scores are added.
+    Scores are kept positive, the search uses 0 for a dead position.
+    """
+    row_tables, col_table = heuristic[0], heuristic[1]
+    tile_score = 0.0
+    empty_tiles = 0.0
+    line_score = 0.0
+    for i in range(4):
+        entry = row_tables[i, bitboard.get_row(board, i)]
+        tile_score += entry[TILE_SCORE]
+        empty_tiles += entry[EMPTY_TILES]
+        line_score += entry[LINE_SCORE]
+
+    transposed = bitboard.transpose(board)
+    for i in range(4):
+        line_score += col_table[bitboard.get_row(transposed, i)]
+
+    return max(tile_score * empty_tiles + line_score, 0.0)
+
+@njit(cache=True)
+def upper_bound(board, moves, heuristic):
+    """
+    Upper bound of the evaluation of the boards which are reached from the board
+    with 1 to moves new tiles, each followed by a move. It holds for every
+    sequence of 2s and 4s: a move merges equal pairs of tiles at most once, so
+    all pairs are merged once per move and the largest tiles are put on the
+    largest weights. After the first move a row or column keeps at least half
+    of its tiles.
+    """
+    weights = heuristic[SORTED_WEIGHTS]
+    base = np.zeros(32, dtype=np.int64)
+    for pos in range(16):
+        base[bitboard.get_tile(board, pos)] += 1
+    base[0] = 0
+    min_tiles = min(_min_tiles_after_move(board), _min_tiles_after_move(bitboard.transpose(board)))
+
+    bound = 0.0
+    counts = np.empty_like(base)
+    for tiles in range(1 << moves):
+        counts[:] = base
+        for i in range(moves):
+            # bit i of tiles picks the rank of the i-th new tile
+            counts[1 + ((tiles >> i) & 1)] += 1
+            # from the largest rank down, a merged tile isn't merged again
+            for rank in range(15 + i, 0, -1):
+                pairs = counts[rank] // 2
+                counts[rank] -= 2 * pairs
+                counts[rank + 1] += pairs
+
+            tile_score = 0.0
+            n = 0
+            for rank in range(16 + i, 0, -1):
+                for _ in range(counts[rank]):
+                    if n < 16:
+                        tile_score += weights[n] * 4.0 ** rank
+                    n += 1
+            if i == 0:
+                n = max(n, min_tiles)
+            bound = max(bound, tile_score * max(16 - n, 0))
+
+    return bound + heuristic[MAX_LINE_SCORE]
+
+@njit(cache=True)
+def _min_tiles_after_move(board):
+    """
+    Tiles left after a move along the rows, at least half of every row
+    """
+    tiles = 0
+    for i in range(4):
+        n = 0
+        for j in range(4):
+            if bitboard.get_tile(board, 4 * i + j) != 0:
+                n += 1
+        tiles += (n + 1) // 2
+    return tiles
@@ -0,0 +1,132 @@
+# -*- coding: UTF-8 -*-
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from statistics import median
+
+import bitboard
+import searchai
+
+# Author:      chrn
+# Description: Play many games at once, one in every browser tab or headless game.
+#              Every tab runs in its own thread and waits for the browser, the moves
+#              are searched by a pool which is shared by all tabs.
+
+def search_task(board):
+    ''' Search the packed board, in a pool worker or the search thread. '''
+    return searchai.find_best_move(bitboard.to_board(board))
+
+
+class SearchService(object):
+    ''' Search moves for all tabs.
+
+    A tab waits for its move before it asks for the next one, so it has at most
+    one request in the queue. Requests are served first come first served, a tab
+    waits for at most one search of every other tab. '''
+
+    def __init__(self, workers=1):
+        # compile before the first move and before forking, see searchai.start_pool()
+        searchai.warmup()
+        if workers > 1:
+            self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'))
+            # all workers are forked with the first task. Create the service before the
+            # tabs are attached, chromectrl runs its event loop in a thread which a fork would copy.
+            self.executor.submit(int).result()
+        else:
+            # the search isn't thread safe, one thread searches for everyone
+            self.executor = ThreadPoolExecutor(1)
+
+    def find_best_move(self, board):
+        return self.executor.submit(search_task, board).result()
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class GameFarm(object):
+    ''' Play games in several tabs until the number of games is reached.
+
+    service is a SearchService, by default one with workers processes. '''
+
+    def __init__(self, gamectrls, games, workers=1, verbose=0, service=None):
+        self.gamectrls = gamectrls
+        self.games = games
+        self.verbose = verbose
+        self.service = SearchService(workers) if service is None else service
+        self.lock = threading.Lock()
+        self.started = 0
+        self.results = [] # (tab, score, highest tile, moves, seconds)
+        self.errors = []
+
+    def run(self):
+        start = time.time()
+        threads = [threading.Thread(target=self._run_tab, args=(tab, gamectrl))
+                   for tab, gamectrl in enumerate(self.gamectrls)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.service.shutdown()
+        self.seconds = time.time() - start
+
+        for tab, error in self.errors:
+            print("Tab %d failed: %s" % (tab + 1, error))
+        return self.results
+
+    def _next_game(self):
+        with self.lock:
+            if self.started >= self.games:
+                return False
+            self.started += 1
+            return True
+
+    def _run_tab(self, tab, gamectrl):
+        try:
+            while self._next_game():
+                gamectrl.restart_game()
+                result = self.play_game(gamectrl)
+                with self.lock:
+                    self.results.append((tab,) + result)
+                if self.verbose >= 1:
+                    print("Tab %d: score %d, highest tile %d, %d moves in %.1fs" % ((tab + 1,) + result))
+        except Exception as e:
+            with self.lock:
+                self.errors.append((tab, e))
+
+    def play_game(self, gamectrl):
+        start = time.time()
+        moves = 0
+        while 1:
+            snapshot = gamectrl.get_snapshot()
+            if snapshot.status == 'ended':
+                break
+            elif snapshot.status == 'won':
+                gamectrl.continue_game()
+
+            move = self.service.find_best_move(snapshot.board)
+            if move < 0:
+                break
+            gamectrl.execute_move(move)
+            moves += 1
+
+        snapshot = gamectrl.get_snapshot()
+        maxval = int(bitboard.to_board(snapshot.board).max())
+        return snapshot.score, maxval, moves, time.time() - start
+
+    def games_per_hour(self):
+        return len(self.results) * 3600 / self.seconds if self.seconds > 0 else 0.0
+
+    def report(self):
+        if not self.results:
+            return "No games finished"
+        scores = [score for _, score, _, _, _ in self.results]
+        moves = sum(result[3] for result in self.results)
+        tabs = [sum(1 for result in self.results if result[0] == tab) for tab in range(len(self.gamectrls))]
+        return ("Games: %d in %d tabs, %.1f games/hour, %.1f moves/s, highest score: %d, median: %d, "
+                "highest tile: %d, games per tab: %s") % (
+            len(self.results), len(self.gamectrls), self.games_per_hour(), moves / self.seconds,
+            max(scores), median(scores), max(result[2] for result in self.results),
+            ' '.join(str(n) for n in tabs))
@@ -1,7 +1,10 @@
 # -*- coding: UTF-8 -*-
 import random
 import numpy as np
-from numba import jit
+from numba import njit
+
+import bitboard
+from util import UP, DOWN, LEFT, RIGHT
 
 # Author:      chrn (original by Micha Schwendener)
 # Date:				 11.11.2016
@@ -62,11 +65,9 @@ def merge_left(b):
         board.append(merged)
     return np.array(board)
 
-@jit(cache=True)
 def remove_zeros(arr):
     return [x for x in arr if x != 0]
 
-@jit
 def merge(row, acc):
     """
     Recursive helper for merge_left. If we're finished with the list,
@@ -89,7 +90,6 @@ def merge(row, acc):
 
     return merge(row[2:], acc + [2*x]) if x == row[1] else merge(row[1:], acc + [x])
 
-@jit
 def move_exists(b):
     """
     Check whether or not a move exists on the board
@@ -106,3 +106,104 @@ def move_exists(b):
             if x == y or x == 0 or y == 0:
                 return True
     return False
+
+
+class BatchGame(object):
+    """
+    Play many games at once. All boards are advanced together by compiled kernels
+    on 64 bit boards (see bitboard.py), there is no loop over the games in python.
+    Tiles spawn like in the original game: a 2 with probability 0.9, otherwise a 4.
+    >>> env = BatchGame()
+    >>> boards, legal = env.reset(3, seed=1)
+    >>> boards.shape, legal.shape
+    ((3, 4, 4), (3, 4))
+    >>> boards, rewards, done, legal = env.step(np.array([LEFT, LEFT, UP]))
+    >>> rewards.shape, done.tolist()
+    ((3,), [False, False, False])
+    """
+
+    def __init__(self):
+        self.rng = None
+        self.bitboards = np.zeros(0, dtype=np.uint64)
+        self.scores = np.zeros(0, dtype=np.int64)
+        self.done = np.zeros(0, dtype=np.bool_)
+        self.legal = np.zeros((0, 4), dtype=np.bool_)
+        self.boards = np.zeros((0, 4, 4), dtype=np.uint32)
+
+    def reset(self, n, seed=None):
+        """
+        Start n new games with two random tiles each
+        Returns: boards (n, 4, 4) with the tile values, legal moves (n, 4)
+        """
+        self.rng = np.random.RandomState(seed)
+        self.bitboards = np.zeros(n, dtype=np.uint64)
+        self.scores = np.zeros(n, dtype=np.int64)
+        self.done = np.zeros(n, dtype=np.bool_)
+        self.legal = np.zeros((n, 4), dtype=np.bool_)
+        self.boards = np.zeros((n, 4, 4), dtype=np.uint32)
+
+        _batch_reset(self.bitboards, self.rng.random_sample((n, 4)), self.boards, self.legal, self.done)
+        return self.boards, self.legal
+
+    def step(self, moves):
+        """
+        Execute one move in every game. Illegal moves and moves in finished
+        games leave the board unchanged and score nothing.
+        Returns: boards (n, 4, 4), score deltas (n,), done flags (n,), legal moves (n, 4)
+        """
+        moves = np.asarray(moves, dtype=np.int64)
+        rewards = np.zeros(self.bitboards.shape[0], dtype=np.int64)
+        _batch_step(self.bitboards, moves, self.rng.random_sample((moves.shape[0], 2)),
+                    rewards, self.boards, self.legal, self.done)
+        self.scores += rewards
+        return self.boards, rewards, self.done, self.legal
+
+
+@njit(cache=True)
+def _add_random_tile(board, r_pos, r_value):
+    empty = bitboard.count_empty_tiles(board)
+    if empty == 0:
+        return board
+    target = min(int(r_pos * empty), empty - 1)
+    rank = 1 if r_value < 0.9 else 2
+    for pos in range(16):
+        if bitboard.get_tile(board, pos) == 0:
+            if target == 0:
+                return bitboard.set_tile(board, pos, rank)
+            target -= 1
+    return board
+
+@njit(cache=True)
+def _update_outputs(i, board, boards, legal, done):
+    any_legal = False
+    for move in range(4):
+        legal[i, move] = bitboard.execute_move(move, board) != board
+        any_legal = any_legal or legal[i, move]
+    done[i] = not any_legal
+
+    for pos in range(16):
+        rank = bitboard.get_tile(board, pos)
+        boards[i, pos // 4, pos % 4] = 0 if rank == 0 else 1 << rank
+
+@njit(cache=True)
+def _batch_reset(bitboards, rand, boards, legal, done):
+    for i in range(bitboards.shape[0]):
+        board = _add_random_tile(np.uint64(0), rand[i, 0], rand[i, 1])
+        board = _add_random_tile(board, rand[i, 2], rand[i, 3])
+        bitboards[i] = board
+        _update_outputs(i, board, boards, legal, done)
+
+@njit(cache=True)
+def _batch_step(bitboards, moves, rand, rewards, boards, legal, done):
+    for i in range(bitboards.shape[0]):
+        if done[i]:
+            continue
+        board = bitboards[i]
+        newboard = bitboard.execute_move(moves[i], board)
+        if newboard == board:
+            continue
+
+        rewards[i] = bitboard.move_score(moves[i], board)
+        newboard = _add_random_tile(newboard, rand[i, 0], rand[i, 1])
+        bitboards[i] = newboard
+        _update_outputs(i, newboard, boards, legal, done)
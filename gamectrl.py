@@ -3,13 +3,108 @@ import math
 import re
 import time
 import json
+import collections
 import numpy as np
 
+import bitboard
+
 # Author:      chrn (original by nneonneo)
 # Date:				 11.11.2016
 # Copyright:	 https://github.com/nneonneo/2048-ai
 # Description: Read information from the browser and send key input to it to control the game.
 
+# State of the game read at once. board is the packed 64 bit board of bitboard.py,
+# moves the number of moves of the current game or None if it isn't known.
+Snapshot = collections.namedtuple('Snapshot', ('status', 'score', 'moves', 'board'))
+
+# Moves and restarts are confirmed by polling the page, the interval doubles
+# up to MAX_POLL_INTERVAL. After ACK_TIMEOUT seconds the control gives up.
+POLL_INTERVAL = 0.001
+MAX_POLL_INTERVAL = 0.032
+ACK_TIMEOUT = 2.0
+
+# Javascript which packs the board into 16 hex digits, the log2 of every tile
+# in row major order. Expects the tiles to be set in the array ranks.
+PACK_RANKS = '''
+    var packed = '';
+    for(var i = 0; i < 16; i++)
+        packed += Math.min(ranks[i], 15).toString(16);
+    '''
+
+# packed board of the hooked GameManager
+GAME_RANKS = '''
+    var game = GameManager._instance;
+    var ranks = [];
+    for(var i = 0; i < 16; i++) {
+        var tile = game.grid.cells[i % 4][i >> 2];
+        ranks.push(tile ? Math.round(Math.log(tile.value) / Math.LN2) : 0);
+    }
+    ''' + PACK_RANKS
+
+# packed board of the tiles shown on the page,
+# merged tiles share the position with the tiles they were merged from
+DOM_RANKS = '''
+    var ranks = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0];
+    var tiles = tileContainer.children;
+    for(var i = 0; i < tiles.length; i++) {
+        var value = tiles[i].className.match(/(^| )tile-(\\d+)( |$)/);
+        var pos = tiles[i].className.match(/tile-position-(\\d+)-(\\d+)/);
+        if(!value || !pos) continue;
+        var index = 4 * (pos[2] - 1) + (pos[1] - 1);
+        ranks[index] = Math.max(ranks[index], Math.round(Math.log(value[2]) / Math.LN2));
+    }
+    ''' + PACK_RANKS
+
+def unpack(packed):
+    ''' Packed 64 bit board from the 16 hex digits of PACK_RANKS. '''
+    # the first tile is the first digit but the lowest nibble of the board
+    return int(packed[::-1], 16)
+
+def parse_snapshot(result):
+    '''
+    Parse the string "status score moves packed" returned by the snapshot javascript.
+
+    >>> parse_snapshot('running 1234 56 1200000000000002')
+    Snapshot(status='running', score=1234, moves=56, board=2305843009213693985)
+    >>> bitboard.to_board(parse_snapshot('won 0 - 1200000000000002').board)[0]
+    array([2, 4, 0, 0], dtype=uint32)
+    '''
+    status, score, moves, packed = result.split()
+    return Snapshot(status, int(score), None if moves == '-' else int(moves), unpack(packed))
+
+def is_spawned(moved, board):
+    '''
+    True if the packed board is the packed board moved with one new 2 or 4.
+    The page draws a move first with the tiles at their old positions, only
+    the new and the merged tiles differ from the board before the move.
+
+    >>> is_spawned(0x21, 0x121), is_spawned(0x21, 0x221), is_spawned(0x21, 0x21)
+    (True, True, False)
+    >>> is_spawned(0x21, 0x1121), is_spawned(0x21, 0x321), is_spawned(0x21, 0x12)
+    (False, False, False)
+    '''
+    new_tiles = 0
+    for pos in range(16):
+        old = (moved >> (4 * pos)) & 0xF
+        new = (board >> (4 * pos)) & 0xF
+        if old == new:
+            continue
+        if old != 0 or new not in (1, 2):
+            return False
+        new_tiles += 1
+    return new_tiles == 1
+
+def wait_for(condition, timeout=None):
+    ''' Poll condition() until it is true. Returns False after timeout seconds, default ACK_TIMEOUT. '''
+    interval = POLL_INTERVAL
+    deadline = time.time() + (ACK_TIMEOUT if timeout is None else timeout)
+    while not condition():
+        if time.time() >= deadline:
+            return False
+        time.sleep(interval)
+        interval = min(interval * 2, MAX_POLL_INTERVAL)
+    return True
+
 class Generic2048Control(object):
     def __init__(self, ctrl):
         self.ctrl = ctrl
@@ -30,23 +125,34 @@ class Generic2048Control(object):
             else {"running"}
             ''')
 
+    def get_snapshot(self):
+        ''' Read status, score, move count and packed board. Controls of a browser
+        read them with a single javascript evaluation. '''
+        return Snapshot(self.get_status(), self.get_score(), None, bitboard.to_bitboard(self.get_board()))
+
     def restart_game(self):
-        self.send_key_event('keydown', 82)
-        time.sleep(0.1)
-        self.send_key_event('keyup', 82)
+        ''' Restart and wait until the new game is shown. Returns False if it timed out. '''
+        self.execute(self.key_event_script('keydown', 82) + self.key_event_script('keyup', 82) +
+                     self.key_event_script('keydown', 32) + self.key_event_script('keyup', 32))
+        return wait_for(self.is_new_game)
 
-        self.send_key_event('keydown', 32)
-        time.sleep(0.1)
-        self.send_key_event('keyup', 32)
+    def is_new_game(self):
+        snapshot = self.get_snapshot()
+        tiles = sum(1 for pos in range(16) if (snapshot.board >> (4 * pos)) & 0xF)
+        return snapshot.status == 'running' and snapshot.score == 0 and tiles <= 2
 
     def continue_game(self):
         ''' Continue the game. Only works if the game is in the 'won' state. '''
         self.execute('document.querySelector(".keep-playing-button").click();')
+        return wait_for(lambda: self.get_status() != 'won')
 
     def send_key_event(self, action, key):
+        return self.execute(self.key_event_script(action, key))
+
+    def key_event_script(self, action, key):
         # Use generic events for compatibility with Chrome, which (for inexplicable reasons) doesn't support setting keyCode on KeyboardEvent objects.
         # See http://stackoverflow.com/questions/8942678/keyboardevent-in-chrome-keycode-is-0.
-        return self.execute('''
+        return '''
             var keyboardEvent = document.createEventObject ? document.createEventObject() : document.createEvent("Events");
             if(keyboardEvent.initEvent)
                 keyboardEvent.initEvent("%(action)s", true, true);
@@ -54,7 +160,7 @@ class Generic2048Control(object):
             keyboardEvent.which = %(key)s;
             var element = document.body || document;
             element.dispatchEvent ? element.dispatchEvent(keyboardEvent) : element.fireEvent("on%(action)s", keyboardEvent);
-            ''' % locals())
+            ''' % locals()
 
 class Fast2048Control(Generic2048Control):
     ''' Control 2048 by hooking the GameManager and executing its move() function.
@@ -79,6 +185,23 @@ class Fast2048Control(Generic2048Control):
 
         self.execute('GameManager.prototype.isGameTerminated = _func_tmp;')
 
+        # Count the moves of the game. actuate() follows every move and a new game,
+        # only after a move some tiles have moved or merged.
+        self.execute(
+            '''
+            if(!GameManager.prototype._actuate_tmp) {
+                GameManager.prototype._actuate_tmp = GameManager.prototype.actuate;
+                GameManager.prototype.actuate = function() {
+                    var moved = false;
+                    this.grid.eachCell(function(x, y, tile) {
+                        if(tile && (tile.previousPosition || tile.mergedFrom)) moved = true;
+                    });
+                    this.moveCount = moved ? (this.moveCount || 0) + 1 : 0;
+                    return this._actuate_tmp.apply(this, arguments);
+                };
+            }
+            ''')
+
     def get_status(self):
         ''' Check if the game is in an unusual state. '''
         return self.execute('''
@@ -106,17 +229,24 @@ class Fast2048Control(Generic2048Control):
 
         return board
 
+    def get_snapshot(self):
+        return parse_snapshot(self.execute(GAME_RANKS + '''
+            var status = game.over ? "ended" : (game.won && !game.keepPlaying ? "won" : "running");
+            [status, game.score, game.moveCount || 0, packed].join(" ");
+            '''))
+
     def execute_move(self, move):
         # We use UDLR ordering; 2048 uses URDL ordering
         move = [0, 2, 3, 1][move]
+        # the GameManager moves right away, there is nothing to wait for
         self.execute('GameManager._instance.move(%d)' % move)
+        return True
 
 class Keyboard2048Control(Generic2048Control):
     ''' Control 2048 by accessing the DOM and using key events.
 
-    This is relatively slow, and may be prone to race conditions if your
-    browser is slow. However, it is more generally compatible with various
-    clones of 2048. '''
+    This is relatively slow, every move waits until the page shows it.
+    However, it is more generally compatible with various clones of 2048. '''
 
     def setup(self):
         self.execute(
@@ -167,12 +297,49 @@ class Keyboard2048Control(Generic2048Control):
 
         return board
 
+    def get_snapshot(self):
+        ''' The page doesn't show the number of moves, it is None. '''
+        return parse_snapshot(self.execute('''
+            var messageContainer = document.querySelector(".game-message");
+            var status = "running";
+            if(messageContainer.className.search(/game-over/) !== -1) status = "ended";
+            else if(messageContainer.className.search(/game-won/) !== -1) status = "won";
+
+            var scoreContainer = document.querySelector(".score-container");
+            var score = '';
+            for(var i = 0; i < scoreContainer.childNodes.length; ++i)
+                if(scoreContainer.childNodes[i].nodeType == Node.TEXT_NODE)
+                    score += scoreContainer.childNodes[i].textContent;
+
+            ''' + DOM_RANKS + '''
+            [status, parseInt(score, 10) || 0, "-", packed].join(" ");
+            '''))
+
+    # body of a javascript function which returns a string starting with the
+    # packed board, the string changes with every move
+    MOVE_STATE = DOM_RANKS + 'return packed;'
+
     def execute_move(self, move):
+        '''
+        Send the keys and wait until the move has been applied.
+        Returns False if it timed out.
+        '''
         key = [38, 40, 37, 39][move]
-        self.send_key_event('keydown', key)
-        time.sleep(0.01)
-        self.send_key_event('keyup', key)
-        time.sleep(0.05)
+        state = '(function() { %s })()' % self.MOVE_STATE
+        # read the state and send the keys with one evaluation
+        before = self.execute('var state = %s; %s %s state;' % (
+            state, self.key_event_script('keydown', key), self.key_event_script('keyup', key)))
+
+        # a move which doesn't change the board is never applied
+        board = np.uint64(unpack(before[:16]))
+        moved = int(bitboard.execute_move(move, board))
+        if moved == board:
+            return True
+        return wait_for(lambda: self.is_applied(self.execute(state), before, moved))
+
+    def is_applied(self, state, before, moved):
+        ''' The tiles have slid to the moved board and the new tile is shown. '''
+        return is_spawned(moved, unpack(state[:16]))
 
 class Hybrid2048Control(Fast2048Control, Keyboard2048Control):
     ''' Control 2048 by hooking the GameManager and using keyboard inputs.
@@ -184,4 +351,11 @@ class Hybrid2048Control(Fast2048Control, Keyboard2048Control):
     get_status = Keyboard2048Control.get_status
     get_score = Fast2048Control.get_score
     get_board = Fast2048Control.get_board
+    get_snapshot = Fast2048Control.get_snapshot
     execute_move = Keyboard2048Control.execute_move
+
+    # the move counter of the GameManager confirms the move without waiting for the page
+    MOVE_STATE = GAME_RANKS + 'return packed + " " + (game.moveCount || 0);'
+
+    def is_applied(self, state, before, moved):
+        return state != before
@@ -0,0 +1,131 @@
+# -*- coding: UTF-8 -*-
+import os
+import numpy as np
+
+import bitboard
+
+# Author:      chrn
+# Description: Record games as fixed size binary records, one for every turn. Trace files
+#              are memory mapped by the reader and handed out as numpy structured arrays,
+#              so millions of moves can be filtered without parsing anything.
+
+MAGIC = b'2048TRACE\0\0\0\0\0\0\1'
+HEADER_SIZE = 32
+
+RECORD_DTYPE = np.dtype([
+    ('board', '<u8'),      # packed board before the move
+    ('score', '<u4'),      # score before the move
+    ('game', '<u4'),       # number of the game in the file
+    ('turn', '<u4'),       # number of the move in the game, from 0
+    ('latency', '<f4'),    # time to find the move in milliseconds
+    ('value', '<f4'),      # search score of the move
+    ('move', 'u1'),
+    ('depth', 'u1'),       # search depth
+    ('spawn_pos', 'u1'),   # tile which appeared after the move, NO_SPAWN at the end of a game
+    ('spawn_rank', 'u1'),  # log2 of the new tile
+])
+
+NO_SPAWN = 255
+
+
+class TraceWriter(object):
+    ''' Append games to a trace file.
+
+    A turn is kept until the next board of the game is known, which shows the
+    new tile. Records are written in chunks of buffer_records. '''
+
+    def __init__(self, path, buffer_records=4096):
+        self.path = path
+        # continue the game numbers of an existing file
+        self.next_game = 0
+        if os.path.exists(path) and os.path.getsize(path) > HEADER_SIZE:
+            records = read_trace(path)
+            self.next_game = int(records['game'].max()) + 1 if len(records) else 0
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC.ljust(HEADER_SIZE, b'\0'))
+        self.buffer = np.zeros(buffer_records, dtype=RECORD_DTYPE)
+        self.count = 0
+        self.game = None
+        self.turn = 0
+
+    def start_game(self):
+        self.end_game()
+        self.game = self.next_game
+        self.next_game += 1
+        self.turn = 0
+
+    def add_turn(self, board, move, score, depth=0, latency=0.0, value=0.0):
+        ''' Record a move on the packed board. '''
+        if self.game is None:
+            self.start_game()
+        if self.turn > 0:
+            self._set_spawn(board)
+        if self.count == len(self.buffer):
+            self.flush()
+
+        record = self.buffer[self.count]
+        record['board'] = board
+        record['score'] = score
+        record['game'] = self.game
+        record['turn'] = self.turn
+        record['latency'] = latency
+        record['value'] = value
+        record['move'] = move
+        record['depth'] = depth
+        record['spawn_pos'] = NO_SPAWN
+        self.count += 1
+        self.turn += 1
+
+    def _set_spawn(self, board):
+        ''' Find the new tile of the last turn in the board which followed it. '''
+        last = self.buffer[self.count - 1] if self.count else None
+        if last is None:
+            # the last turn has already been written
+            return
+        moved = np.uint64(bitboard.execute_move(int(last['move']), np.uint64(last['board'])))
+        for pos in range(16):
+            if bitboard.get_tile(moved, pos) == 0 and bitboard.get_tile(np.uint64(board), pos) != 0:
+                last['spawn_pos'] = pos
+                last['spawn_rank'] = bitboard.get_tile(np.uint64(board), pos)
+                break
+
+    def end_game(self):
+        self.game = None
+
+    def flush(self):
+        # the last turn waits for its new tile
+        keep = 1 if self.game is not None and self.count else 0
+        self.file.write(self.buffer[:self.count - keep].tobytes())
+        self.file.flush()
+        if keep:
+            self.buffer[0] = self.buffer[self.count - 1]
+        self.count = keep
+
+    def close(self):
+        self.end_game()
+        self.flush()
+        self.file.close()
+
+
+def read_trace(path):
+    ''' Memory map all records of a trace file. '''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a trace file" % path)
+    records = (os.path.getsize(path) - HEADER_SIZE) // RECORD_DTYPE.itemsize
+    if records == 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE, shape=(records,))
+
+def iter_trace(paths, chunk_records=1 << 20):
+    """
+    Yield the records of the trace files in chunks of structured arrays. The chunks
+    are views of the memory mapped files.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    for path in paths:
+        records = read_trace(path)
+        for start in range(0, len(records), chunk_records):
+            yield records[start:start + chunk_records]
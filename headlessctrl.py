@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+import bitboard
+from gamectrl import Generic2048Control, Snapshot
+
+# Author:      chrn
+# Description: Play 2048 without a browser. The game runs in process on a 64 bit board
+#              and follows the rules of the original GameManager.
+
+WIN_TILE = 11 # log2 of 2048
+
+class Headless2048Control(Generic2048Control):
+    ''' Control an in-process game of 2048.
+
+    Tiles spawn like in the original game: a 2 with probability 0.9, otherwise a 4,
+    on a random empty tile. Pass a seed or a numpy RandomState to make games reproducible. '''
+
+    def __init__(self, seed=None):
+        if isinstance(seed, np.random.RandomState):
+            self.rng = seed
+        else:
+            self.rng = np.random.RandomState(seed)
+        Generic2048Control.__init__(self, None)
+
+    def setup(self):
+        self.board = 0
+        self.score = 0
+        self.moves = 0
+        self.over = False
+        self.won = False
+        self.keep_playing = False
+        self.add_random_tile()
+        self.add_random_tile()
+
+    def execute(self, cmd):
+        raise NotImplementedError("The headless game can't execute javascript.")
+
+    def add_random_tile(self):
+        empty = [pos for pos in range(16) if (self.board >> (4 * pos)) & 0xF == 0]
+        if empty:
+            pos = empty[self.rng.randint(len(empty))]
+            rank = 1 if self.rng.random_sample() < 0.9 else 2
+            self.board |= rank << (4 * pos)
+
+    def moves_available(self):
+        board = np.uint64(self.board)
+        return any(bitboard.execute_move(move, board) != board for move in range(4))
+
+    def get_status(self):
+        ''' Check if the game is in an unusual state. '''
+        if self.over:
+            return 'ended'
+        elif self.won and not self.keep_playing:
+            return 'won'
+        else:
+            return 'running'
+
+    def get_score(self):
+        return self.score
+
+    def get_board(self):
+        return bitboard.to_board(self.board)
+
+    def get_snapshot(self):
+        return Snapshot(self.get_status(), self.score, self.moves, self.board)
+
+    def execute_move(self, move):
+        # moves are ignored once the game is over or won, like in the original
+        if self.get_status() != 'running':
+            return
+
+        board = np.uint64(self.board)
+        newboard = int(bitboard.execute_move(move, board))
+        if newboard == self.board:
+            return
+
+        self.score += int(bitboard.move_score(move, board))
+        self.moves += 1
+        self.board = newboard
+        if max((newboard >> (4 * pos)) & 0xF for pos in range(16)) >= WIN_TILE:
+            self.won = True
+
+        self.add_random_tile()
+        if not self.moves_available():
+            self.over = True
+
+    def restart_game(self):
+        self.setup()
+
+    def continue_game(self):
+        ''' Continue the game. Only works if the game is in the 'won' state. '''
+        self.keep_playing = True
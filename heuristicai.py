@@ -1,6 +1,10 @@
 import random
 import game
 import sys
+import numpy as np
+from numba import njit
+
+import bitboard
 
 from util import get_possible_merges, UP, DOWN, LEFT, RIGHT
 
@@ -20,17 +24,186 @@ def find_best_move(board):
 
 	# Build a heuristic agent on your own that is much better than the random agent.
 	# Your own agent don't have to beat the game.
-    bestmove = find_best_move_rule_agent(board, THRESHOLD)
+    bestmove = int(find_best_moves(np.array([bitboard.to_bitboard(board)], dtype=np.uint64))[0])
     if bestmove == -1:
         # Fallback to random agent if no optimal move has been found
         # print('random')
         bestmove = find_best_move_random_agent()
     return bestmove
 
+def find_best_moves(boards):
+    """
+    Moves of the rule agent for an array of packed boards, -1 where no rule
+    finds a move. Gives the same moves as find_best_move_rule_agent() with
+    the current THRESHOLD and weights.
+    """
+    weights = np.array([BEST_MERGE_WEIGHT, FUTURE_MERGE_WEIGHT], dtype=np.float64)
+    return _rule_moves(np.asarray(boards, dtype=np.uint64), float(THRESHOLD), float(MIN_THRESHOLD),
+                       np.asarray(DIRECTION_WEIGHT, dtype=np.float64), weights)
+
 def find_best_move_random_agent():
     return random.choice([UP, DOWN, LEFT, RIGHT])
 
+
+# The rules below look at one board many times. find_best_moves() evaluates them
+# in one pass with a table of the merges of every possible line.
+
+NO_MERGE, MERGE_BACKWARD, MERGE_FORWARD = range(3)
+
+def _build_merge_table():
+    """
+    For all 65536 lines of 4 bit tiles: the merge get_possible_merges() finds for
+    every tile, 2 bits per tile. MERGE_BACKWARD is left in a row and up in a
+    column, it is only looked for from the third tile on like in has_horizontal_merge().
+    """
+    lines = np.arange(65536, dtype=np.int64)
+    ranks = (lines[:, np.newaxis] >> (4 * np.arange(4))) & 0xF
+    table = np.zeros(65536, dtype=np.uint8)
+    for i in range(4):
+        # the nearest tiles before (down to the second one) and after tile i
+        backward = np.zeros(65536, dtype=np.int64)
+        for j in range(1, i):
+            backward = np.where(ranks[:, j] != 0, ranks[:, j], backward)
+        forward = np.zeros(65536, dtype=np.int64)
+        for j in range(3, i, -1):
+            forward = np.where(ranks[:, j] != 0, ranks[:, j], forward)
+
+        tile = ranks[:, i]
+        is_backward = (tile != 0) & (i > 1) & (backward == tile)
+        is_forward = (tile != 0) & (i < 3) & (forward == tile) & ~is_backward
+        table |= (np.where(is_backward, MERGE_BACKWARD, 0) | np.where(is_forward, MERGE_FORWARD, 0)).astype(np.uint8) << (2 * i)
+    return table
+
+MERGE_TABLE = _build_merge_table()
+
+@njit(cache=True)
+def _merges(board, direction_weight, counts):
+    """
+    The first result of get_possible_merges() as (number, move), (-1, -1) if there
+    is none, and the number of merges of every move in counts
+    """
+    transposed = bitboard.transpose(board)
+    counts[:] = 0
+    best = -1.0
+    best_move = -1
+    for y in range(4):
+        row = MERGE_TABLE[bitboard.get_row(board, y)]
+        for x in range(4):
+            rank = bitboard.get_tile(board, 4 * y + x)
+            if rank == 0:
+                continue
+            merge = (row >> (2 * x)) & 3
+            if merge == MERGE_BACKWARD:
+                move = LEFT
+            elif merge == MERGE_FORWARD:
+                move = RIGHT
+            # merges up are found but not used
+            elif (MERGE_TABLE[bitboard.get_row(transposed, x)] >> (2 * y)) & 3 == MERGE_FORWARD:
+                move = DOWN
+            else:
+                continue
+            number = (1 << rank) * direction_weight[move]
+            counts[move] += 1
+            # the merges are sorted by number, the first one wins a tie
+            if best_move == -1 or number > best:
+                best = number
+                best_move = move
+    return best, best_move
+
+@njit(cache=True)
+def _line_sum(line):
+    total = 0
+    for i in range(4):
+        rank = (line >> np.uint64(4 * i)) & np.uint64(0xF)
+        if rank > 0:
+            total += 1 << rank
+    return total
+
+@njit(cache=True)
+def _optimal_position_move(board, legal):
+    """
+    find_move_by_optimal_position(): left if a column is larger than the left one,
+    otherwise up if a row is larger than the top one
+    """
+    transposed = bitboard.transpose(board)
+    up = False
+    left = False
+    for i in range(4):
+        up = up or _line_sum(bitboard.get_row(board, i)) > _line_sum(bitboard.get_row(board, 0))
+        left = left or _line_sum(bitboard.get_row(transposed, i)) > _line_sum(bitboard.get_row(transposed, 0))
+    if left and legal[LEFT]:
+        return LEFT
+    if up and legal[UP]:
+        return UP
+    return -1
+
+@njit(cache=True)
+def _rule_move(board, threshold, min_threshold, direction_weight, weights):
+    """
+    find_best_move_rule_agent() on a packed board
+    """
+    counts = np.zeros(4, dtype=np.int64)
+    future_counts = np.zeros(4, dtype=np.int64)
+    legal = np.zeros(4, dtype=np.bool_)
+    merge, merge_move = _merges(board, direction_weight, counts)
+
+    # find_move_by_future_outcome() and find_move_by_number_of_merges()
+    future = 0.0
+    future_move = -1
+    most = 0
+    most_move = -1
+    for move in range(4):
+        newboard = bitboard.execute_move(move, board)
+        legal[move] = newboard != board
+        number, _ = _merges(newboard, direction_weight, future_counts)
+        if number > future:
+            future = number
+            future_move = move
+        if counts[move] > most:
+            most = counts[move]
+            most_move = move
+
+    # the threshold only changes the first two rules
+    moves = np.zeros(3, dtype=np.int64)
+    values = np.zeros(3, dtype=np.float64)
+    while True:
+        moves[0] = merge_move if merge_move >= 0 and merge > threshold else -1
+        values[0] = merge * weights[0]
+        moves[1] = future_move if future > threshold else -1
+        values[1] = future * weights[1]
+        moves[2] = most_move if most > 2 else -1
+        values[2] = most ^ 2
+
+        # select_best_possible_move(): the highest value, the next one if the move is illegal
+        while True:
+            best = -1
+            for i in range(3):
+                if moves[i] >= 0 and values[i] > 0 and (best == -1 or values[i] > values[best]):
+                    best = i
+            if best == -1 or legal[moves[best]]:
+                break
+            moves[best] = -1
+        if best >= 0:
+            return moves[best]
+
+        if threshold > min_threshold:
+            threshold = threshold / 2
+        else:
+            return _optimal_position_move(board, legal)
+
+@njit(cache=True)
+def _rule_moves(boards, threshold, min_threshold, direction_weight, weights):
+    result = np.empty(boards.shape[0], dtype=np.int64)
+    for i in range(boards.shape[0]):
+        result[i] = _rule_move(boards[i], threshold, min_threshold, direction_weight, weights)
+    return result
+
+
 def find_best_move_rule_agent(board, threshold=0):
+    """
+    The rules on a two dimensional board. find_best_moves() gives the same moves
+    from the merge table.
+    """
     possible_moves = []
 
     # 1. Rule
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+import os
+import time
+import numpy as np
+from numba import njit
+
+import bitboard
+import evaluation
+import searchai
+import symmetry
+
+# Author:      chrn
+# Description: Best moves of earlier runs, stored in a file as an open addressing hash table.
+#              The file is memory mapped, so several processes can read it at once and
+#              only the pages they touch are loaded.
+
+MAGIC = b'2048MOVECACHE\0\0\1'
+
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S16'),
+    ('fingerprint', '<u8'), # searchai.search_fingerprint() of the search which filled the cache
+    ('size', '<u8'),        # number of entries, a power of two
+])
+HEADER_SIZE = 64
+
+ENTRY_DTYPE = np.dtype([
+    ('key', '<u8'),    # packed board, 0 marks an empty slot
+    ('value', '<f4'),  # score of the best move
+    ('move', 'u1'),
+    ('depth', 'u1'),   # search depth of the move
+    ('pad', '<u2'),
+])
+
+# a board is looked for in this many slots after its hash slot
+MAX_PROBES = 16
+
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+class MoveCache(object):
+    ''' Memory mapped cache of board -> (best move, value, depth).
+
+    Boards are stored in their canonical form under the symmetries of the
+    search heuristic, the images of a board share one entry.
+
+    Open it read only to share it between processes, only one process should
+    write. A writer fills the fields of an entry before its key, readers check
+    the key again after reading the entry. '''
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.writable = writable
+        header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)
+        if len(header) == 0 or header['magic'][0] != MAGIC:
+            raise ValueError("%s is not a move cache" % path)
+        self.fingerprint = int(header['fingerprint'][0])
+        self.entries = np.memmap(path, dtype=ENTRY_DTYPE, mode='r+' if writable else 'r',
+                                 offset=HEADER_SIZE, shape=(int(header['size'][0]),))
+
+    @classmethod
+    def create(cls, path, max_memory_mb=64, fingerprint=None):
+        ''' Create an empty cache file, the size is the largest power of two in the cap. '''
+        size = 2
+        while size * 2 * ENTRY_DTYPE.itemsize <= max_memory_mb * 1024 * 1024:
+            size *= 2
+        header = np.zeros(1, dtype=HEADER_DTYPE)
+        header['magic'] = MAGIC
+        header['fingerprint'] = searchai.search_fingerprint() if fingerprint is None else fingerprint
+        header['size'] = size
+        with open(path, 'wb') as f:
+            f.write(header.tobytes().ljust(HEADER_SIZE, b'\0'))
+            f.truncate(HEADER_SIZE + size * ENTRY_DTYPE.itemsize)
+        return cls(path, writable=True)
+
+    @classmethod
+    def open(cls, path, writable=False, max_memory_mb=64):
+        ''' Open the cache of the current search, a writable cache is created if it doesn't exist. '''
+        if writable and not os.path.exists(path):
+            return cls.create(path, max_memory_mb)
+        cache = cls(path, writable)
+        if cache.fingerprint != searchai.search_fingerprint():
+            raise ValueError("%s was filled by a search with other settings" % path)
+        return cache
+
+    def lookup(self, board, min_depth=0):
+        ''' Return (move, value, depth) of the packed board or None. '''
+        key, t = symmetry.canonical(np.uint64(board), searchai.HEURISTIC[evaluation.SYMMETRIES])
+        # numba hands the key back as int, keys from 2**63 don't fit the int64 signature
+        key = np.uint64(key)
+        index = find(self.entries, key, min_depth)
+        if index < 0:
+            return None
+        move, value, depth = self.entries[['move', 'value', 'depth']][index].tolist()
+        if self.entries['key'][index] != key:
+            return None
+        # the move is stored for the canonical board
+        return symmetry.transform_move(move, symmetry.inverse(t)), value, depth
+
+    def store(self, board, move, value, depth):
+        ''' Store a move unless the cache has one from a deeper search.
+
+        >>> import tempfile
+        >>> cache = MoveCache.create(os.path.join(tempfile.mkdtemp(), 'moves.bin'), 1)
+        >>> cache.store(0x21, 2, 10.0, 3), cache.store(0x8000000000000001, 2, 100.0, 3)
+        (True, True)
+        >>> cache.lookup(0x8000000000000001)
+        (2, 100.0, 3)
+        '''
+        if not self.writable:
+            raise ValueError("%s is opened read only" % self.path)
+        key, t = symmetry.canonical(np.uint64(board), searchai.HEURISTIC[evaluation.SYMMETRIES])
+        key = np.uint64(key)
+        return insert(self.entries, key, symmetry.transform_move(move, t), value, depth)
+
+    def add_game(self, turns):
+        ''' Store the (packed board, move, value, depth) of every turn of a game. '''
+        return sum(self.store(*turn) for turn in turns)
+
+    def flush(self):
+        if self.writable:
+            self.entries.flush()
+
+    def __len__(self):
+        return int(np.count_nonzero(self.entries['key']))
+
+    def __repr__(self):
+        return "MoveCache(%s, entries=%d/%d)" % (self.path, len(self), self.entries.shape[0])
+
+
+@njit(cache=True)
+def _slot(entries, board):
+    # fold the high half in first, the bits of the slot only depend on lower bits of the key
+    return np.int64((((board ^ (board >> np.uint64(32))) * HASH_MULTIPLIER) >> np.uint64(32)) & np.uint64(entries.shape[0] - 1))
+
+@njit(cache=True)
+def find(entries, board, min_depth):
+    """
+    Index of the entry of the board with at least min_depth, or -1
+    """
+    mask = entries.shape[0] - 1
+    index = _slot(entries, board)
+    for i in range(MAX_PROBES):
+        slot = (index + i) & mask
+        key = entries[slot]['key']
+        if key == 0:
+            return -1
+        if key == board:
+            if entries[slot]['depth'] < min_depth:
+                return -1
+            return slot
+    return -1
+
+@njit(cache=True)
+def insert(entries, board, move, value, depth):
+    """
+    Insert or update the entry of the board. Returns False if the entry has a
+    deeper search or the probed slots are full.
+    """
+    mask = entries.shape[0] - 1
+    index = _slot(entries, board)
+    for i in range(MAX_PROBES):
+        slot = (index + i) & mask
+        entry = entries[slot]
+        if entry['key'] == board and entry['depth'] > depth:
+            return False
+        if entry['key'] == board or entry['key'] == 0:
+            entry['value'] = value
+            entry['move'] = move
+            entry['depth'] = depth
+            entry['key'] = board
+            return True
+    return False
+
+
+def opening_boards(plies):
+    """
+    Boards of the first turns: every start position with two tiles and the boards
+    which follow them after plies moves with every possible new tile.
+    """
+    boards = set()
+    for first in range(16):
+        for second in range(first + 1, 16):
+            for a in (1, 2):
+                for b in (1, 2):
+                    boards.add(int(bitboard.set_tile(bitboard.set_tile(np.uint64(0), first, a), second, b)))
+
+    layer = boards
+    for _ in range(plies):
+        following = set()
+        for board in layer:
+            for move in range(4):
+                newboard = np.uint64(bitboard.execute_move(move, np.uint64(board)))
+                if newboard == board:
+                    continue
+                for pos in range(16):
+                    if bitboard.get_tile(newboard, pos) == 0:
+                        following.add(int(bitboard.set_tile(newboard, pos, 1)))
+                        following.add(int(bitboard.set_tile(newboard, pos, 2)))
+        boards |= following
+        layer = following
+    return sorted(boards)
+
+def precompute(cache, plies, depth):
+    """
+    Search the opening boards and store their best moves
+    """
+    boards = opening_boards(plies)
+    print("Searching %d boards at depth %d" % (len(boards), depth))
+    start = time.time()
+    for i, board in enumerate(boards):
+        move, stats = searchai.search(bitboard.to_board(board), depth)
+        cache.store(board, move, stats.value, depth)
+        if (i + 1) % 1000 == 0:
+            print("%d boards, %.1f boards/s" % (i + 1, (i + 1) / (time.time() - start)))
+    cache.flush()
+
+def parse_args(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Create and fill the move cache of the search")
+    parser.add_argument('path', help="Cache file.")
+    parser.add_argument('--create', help="Create a new cache of this size in megabytes.", type=int)
+    parser.add_argument('--precompute', help="Search the opening boards up to this many moves.", type=int)
+    parser.add_argument('-d', '--depth', help="Search depth of the precomputed moves.", default=5, type=int)
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+    if args.create is not None:
+        cache = MoveCache.create(args.path, args.create)
+    else:
+        cache = MoveCache.open(args.path, writable=args.precompute is not None)
+    if args.precompute is not None:
+        precompute(cache, args.precompute, args.depth)
+    print(cache)
+
+if __name__ == '__main__':
+    import sys
+    exit(main(sys.argv[1:]))
@@ -0,0 +1,173 @@
+import random
+import time
+from multiprocessing import Pool
+import numpy as np
+from numba import njit
+
+import bitboard
+from util import UP, DOWN, LEFT, RIGHT
+
+# Author:      chrn
+# Description: Monte Carlo engine. Every legal move is scored by the average points of many
+#              random games played after it. The games are played in batches, all games of a
+#              batch advance together, and the workers of a pool play batches until the
+#              time of the move is up.
+
+# time per move in milliseconds
+MOVE_BUDGET_MS = 50
+# games played after every move in one batch
+BATCH_SIZE = 64
+# moves of a random game, 0 plays until the game ends
+HORIZON = 0
+# 'random' picks any legal move, 'greedy' the one which scores the most points
+POLICY = 'greedy'
+POLICIES = {'random': 0, 'greedy': 1}
+
+# worker processes which are kept for the whole session, see start_pool()
+POOL = None
+WORKERS = 1
+
+
+def find_best_move(board):
+    """
+    Find the best move for the next turn, the move with the highest average
+    score of the random games which follow it.
+    """
+    bestmove, _ = search(board)
+    return bestmove
+
+def search(board, seconds=None):
+    """
+    Play random games after every legal move for seconds, by default MOVE_BUDGET_MS.
+    Returns: (best move or -1 if no move is legal, games played)
+    """
+    board = np.uint64(bitboard.to_bitboard(board))
+    if seconds is None:
+        seconds = MOVE_BUDGET_MS / 1000.0
+    moves = np.array([m for m in (UP, DOWN, LEFT, RIGHT) if bitboard.execute_move(m, board) != board], dtype=np.int64)
+    if len(moves) == 0:
+        return -1, 0
+    if len(moves) == 1:
+        return int(moves[0]), 0
+
+    tasks = [(board, moves, seconds, random.getrandbits(32), BATCH_SIZE, HORIZON, POLICIES[POLICY])
+             for _ in range(WORKERS)]
+    if POOL is None:
+        results = [rollout_task(task) for task in tasks]
+    else:
+        results = POOL.map(rollout_task, tasks)
+
+    totals = sum(total for total, _ in results)
+    games = sum(n for _, n in results)
+    scores = totals[moves] / games
+    return int(moves[np.argmax(scores)]), games * len(moves)
+
+def rollout_task(task):
+    """
+    Play batches until the time is up, at least one. In a pool worker or the main process.
+    Returns: (total points of the games after every move, games per move)
+    """
+    board, moves, seconds, seed, batch_size, horizon, policy = task
+    deadline = time.time() + seconds
+    totals = np.zeros(4, dtype=np.float64)
+    games = 0
+    while 1:
+        totals += play_batch(board, moves, batch_size, horizon, policy, (seed + games) & 0xFFFFFFFF)
+        games += batch_size
+        if time.time() >= deadline:
+            return totals, games
+
+@njit(cache=True, nogil=True)
+def play_batch(board, moves, n, horizon, policy, seed):
+    """
+    Play n games after each of the moves. The games of a move are kept in arrays
+    and all of them do one turn before the next.
+    Returns: total points of the games after every move, indexed by move
+    """
+    np.random.seed(seed)
+    totals = np.zeros(4, dtype=np.float64)
+    boards = np.empty(n, dtype=np.uint64)
+    points = np.zeros(n, dtype=np.float64)
+    alive = np.empty(n, dtype=np.bool_)
+    for move in moves:
+        boards[:] = bitboard.execute_move(move, board)
+        points[:] = bitboard.move_score(move, board)
+        alive[:] = True
+        turn = 0
+        playing = n
+        while playing > 0 and (horizon == 0 or turn < horizon):
+            playing = 0
+            for i in range(n):
+                if not alive[i]:
+                    continue
+                b = _add_random_tile(boards[i])
+                m = _pick_move(b, policy)
+                if m < 0:
+                    alive[i] = False
+                    continue
+                points[i] += bitboard.move_score(m, b)
+                boards[i] = bitboard.execute_move(m, b)
+                playing += 1
+            turn += 1
+        totals[move] = points.sum()
+    return totals
+
+@njit(cache=True, nogil=True)
+def _add_random_tile(board):
+    """
+    A 2 with probability 0.9, otherwise a 4, on a random empty tile
+    """
+    target = np.random.randint(bitboard.count_empty_tiles(board))
+    rank = 1 if np.random.random() < 0.9 else 2
+    for pos in range(16):
+        if bitboard.get_tile(board, pos) == 0:
+            if target == 0:
+                return bitboard.set_tile(board, pos, rank)
+            target -= 1
+    return board
+
+@njit(cache=True, nogil=True)
+def _pick_move(board, policy):
+    """
+    Move of a random game, -1 if no move is legal. Ties of the greedy
+    policy are broken at random.
+    """
+    picked = -1
+    best = -1
+    count = 0
+    for m in range(4):
+        if bitboard.execute_move(m, board) == board:
+            continue
+        value = bitboard.move_score(m, board) if policy == 1 else 0
+        if value > best:
+            best = value
+            picked = m
+            count = 1
+        elif value == best:
+            count += 1
+            if np.random.randint(count) == 0:
+                picked = m
+    return picked
+
+def start_pool(workers):
+    """
+    Start the worker processes, every worker plays its own games for the whole budget
+    """
+    global POOL, WORKERS
+    stop_pool()
+    WORKERS = workers
+    # compile before forking, the workers would all compile and write the numba cache at once
+    warmup()
+    if workers > 1:
+        POOL = Pool(workers)
+
+def warmup():
+    board = np.uint64(bitboard.to_bitboard([[2, 4, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 2]]))
+    play_batch(board, np.array([LEFT], dtype=np.int64), 1, 1, POLICIES[POLICY], 0)
+
+def stop_pool():
+    global POOL
+    if POOL is not None:
+        POOL.close()
+        POOL.join()
+        POOL = None
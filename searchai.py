@@ -1,12 +1,18 @@
 import random
-import game
-import sys
 import math
+import sys
+import time
+import zlib
 from multiprocessing import Pool
-import itertools
 import numpy as np
-from numba import jit, generated_jit, float32, float64, uint8, uint32
-
+from numba import njit
+from numba.core.dispatcher import Dispatcher
+
+import bitboard
+import evaluation
+import searchstats
+import symmetry
+import transposition
 from util import UP, DOWN, LEFT, RIGHT
 
 # Author:      chrn (original by nneonneo)
@@ -16,7 +22,20 @@ from util import UP, DOWN, LEFT, RIGHT
 
 MAX_DEPTH = 4
 MIN_DEPTH = 3
-MAX_NEW_BRANCHES = 5
+# positions which are reached with a lower probability are evaluated without searching deeper.
+# The transposition table ignores the probability, an entry cut off on one path is reused on
+# paths with a higher one, so the scores depend on the order of the search unless it is 0.
+PROBABILITY_CUTOFF = 0.0001
+# moves are cut once their expectation can't beat a better sibling, even if the tiles
+# left all score evaluation.upper_bound(). Only for nodes with up to BOUND_MOVES moves
+# below them, the bound tries 2**moves sequences of new tiles.
+BOUND_PRUNING = True
+BOUND_MOVES = 4
+# search every board also without BOUND_PRUNING and count different best moves in SearchStats
+VERIFY_PRUNING = False
+
+# memory cap of the transposition table in megabytes
+TABLE_MEMORY_MB = 64
 
 
 SNAKE = [   [16, 12, 10, 8],
@@ -30,41 +49,173 @@ CORNER = [  [10, 6, 4, 2],
             [4, 1, 0.5, 0.5],
             [2, 1, 0.5, 0.1]]
 
+WEIGHT_SETS = {'snake': SNAKE, 'corner': CORNER}
+
 TILE_WEIGHTS = SNAKE
 
-TILE_WEIGHTS_FLAT = np.array(TILE_WEIGHTS).flatten()
+# penalties for rows and columns which aren't sorted or have different neighbours
+MONOTONICITY_WEIGHT = 0
+SMOOTHNESS_WEIGHT = 0
+# bonus for every empty tile, on top of the multiplication with the tile score
+EMPTY_WEIGHT = 0
+
+# lookup tables of the leaf evaluation, see set_heuristic()
+HEURISTIC = evaluation.build_tables(TILE_WEIGHTS, MONOTONICITY_WEIGHT, SMOOTHNESS_WEIGHT, EMPTY_WEIGHT)
 
 
 MOVES = [UP,DOWN,LEFT,RIGHT]
 
+# search results are kept between the turns of a game
+TABLE = transposition.TranspositionTable(TABLE_MEMORY_MB)
+
+# worker processes which are kept for the whole session, see start_pool()
+POOL = None
+WORKERS = 1
+SPLIT_CHANCE_NODES = False
+
+# count nodes in SearchStats, without it the counting isn't compiled into the search
+COLLECT_STATS = False
+# called by find_best_move with the SearchStats of every search, e.g. to sum up a game
+STATS_HOOK = None
+
+# MoveCache of earlier runs which is asked before searching, see movecache.py
+MOVE_CACHE = None
+# cached moves of the anytime search need this depth, about what it reaches in 10-20ms
+MOVE_CACHE_BUDGET_DEPTH = 6
+
+# time per move of the anytime search in milliseconds, None uses calculate_max_depth
+MOVE_BUDGET_MS = None
+MAX_ITERATIVE_DEPTH = 16
+UNLIMITED_NODES = 1 << 62
+# a low estimate of the speed in chance nodes, for the levels after the first ones which are too small to time
+MIN_NODES_PER_SECOND = 100000
+# deeper levels are slower per node, only plan with a part of the measured speed
+BUDGET_SAFETY = 0.8
 
-def find_best_move(board):
+
+def find_best_move(board, max_depth=None, new_turn=True):
     """
     find the best move for the next turn.
-    It will split the workload in 4 process for each move.
+    If a pool is running the workload is split in 4 tasks for each move
+    or in one task for each chance node of the first level.
+    max_depth fixes the depth, otherwise it is given by calculate_max_depth or MOVE_BUDGET_MS.
+    new_turn ages the transposition table, see search().
     """
-    bestmove = -1
-    
+    bestmove, stats = search(board, max_depth, new_turn=new_turn)
+    if STATS_HOOK is not None:
+        STATS_HOOK(stats)
+    return bestmove
+
+def search(board, max_depth=None, stop=None, new_turn=True):
     """
-    pool = Pool()
-    result = pool.map(func_star, zip(MOVES, itertools.repeat(board)))
-    bestmove = result.index(max(result))
-    pool.close()
-    pool.join()
-    
+    Search the best move like find_best_move.
+    The board is packed into a 64 bit integer before the search starts.
+    stop is an optional threading.Event which ends the search between two tasks,
+    the move of a stopped search is of no use.
+    new_turn starts a new turn of the transposition table. Several searches of one
+    turn, e.g. of the boards which can follow a move, pass False after the first.
+    Returns: (best move or None if stopped before a result, SearchStats of the search)
     """
-    result = list(map(func_star, zip(MOVES, itertools.repeat(board))))
-    print(result)
+    start = time.time()
+    bestmove = -1
+    board = np.uint64(bitboard.to_bitboard(board))
+    if new_turn:
+        TABLE.new_search()
+    stats = searchstats.SearchStats()
+
+    if max_depth is None and MOVE_BUDGET_MS is None:
+        max_depth = calculate_max_depth(count_empty_tiles(board), MAX_DEPTH)
+
+    if MOVE_CACHE is not None:
+        cached = MOVE_CACHE.lookup(board, MOVE_CACHE_BUDGET_DEPTH if max_depth is None else max_depth)
+        # a move which doesn't change the board would be a broken entry
+        if cached is not None and not board_equals(board, np.uint64(execute_move(cached[0], board))):
+            bestmove, value, depth = cached
+            stats.move_cache_hits = 1
+            stats.finish(depth, time.time() - start, value)
+            return bestmove, stats
+
+    if max_depth is not None:
+        result, _ = score_toplevel_moves(board, max_depth, stats=stats, stop=stop)
+    else:
+        result, max_depth = score_toplevel_moves_iterative(board, MOVE_BUDGET_MS / 1000.0, stats, stop)
+    if result is None:
+        return None, stats
     bestmove = result.index(max(result))
+    if VERIFY_PRUNING and BOUND_PRUNING:
+        pruned, full = verify_pruning(board, int(max_depth))
+        stats.verify_pruning(pruned == full)
 
     # prevent the board from getting stuck
-    if board_equals(board, execute_move(bestmove, board)):
-        print('random')
+    if board_equals(board, np.uint64(execute_move(bestmove, board))):
         bestmove = random.choice([UP, DOWN, LEFT, RIGHT])
-    
-    return bestmove
 
-def score_toplevel_move(move, board):
+    stats.finish(int(max_depth), time.time() - start, max(result))
+    return bestmove, stats
+
+def search_fingerprint():
+    """
+    Checksum of the heuristic and the search settings. Results of searches with
+    another fingerprint can't be reused.
+    """
+    checksum = zlib.crc32(repr((PROBABILITY_CUTOFF,)).encode())
+    for table in HEURISTIC:
+        checksum = zlib.crc32(np.ascontiguousarray(table).tobytes(), checksum)
+    return checksum
+
+def verify_pruning(board, max_depth):
+    """
+    Search the packed board with and without bound pruning, in this process and
+    each time with an empty transposition table, so the full search doesn't reuse
+    the results of the pruned one. The moves can only differ with a PROBABILITY_CUTOFF
+    above 0, see score_chance_node().
+    Returns: (best move of the pruned search, best move of the full search)
+    """
+    global TABLE
+    table = TABLE
+    best = []
+    try:
+        for prune in (True, False):
+            TABLE = transposition.TranspositionTable(TABLE_MEMORY_MB)
+            scores = [score_toplevel_move(move, board, max_depth, prune) for move in MOVES]
+            best.append(scores.index(max(scores)))
+    finally:
+        TABLE = table
+    return best[0], best[1]
+
+def score_toplevel_moves_iterative(board, seconds, stats=None, stop=None):
+    """
+    Anytime search: deepen the search one level at a time until the time is up.
+    The node budget of a level is estimated from the speed of all previous levels,
+    a level which runs out of nodes is discarded.
+    Returns: (scores of the last completed depth, depth)
+    """
+    start = time.time()
+    deadline = start + seconds
+    result, depth = None, 0
+    total_nodes = 0
+
+    for max_depth in range(1, MAX_ITERATIVE_DEPTH + 1):
+        now = time.time()
+        if result is not None and now >= deadline:
+            break
+
+        # the first level is always completed to have a move. The call overhead of
+        # small levels, e.g. with a warm transposition table, makes the speed a low estimate.
+        max_nodes = UNLIMITED_NODES
+        if result is not None:
+            nodes_per_second = max(total_nodes / max(now - start, 1e-6), MIN_NODES_PER_SECOND)
+            max_nodes = max(1, int((deadline - now) * nodes_per_second * BUDGET_SAFETY))
+
+        scores, nodes = score_toplevel_moves(board, max_depth, max_nodes, stats, stop)
+        total_nodes += nodes
+        if scores is None:
+            break
+        result, depth = scores, max_depth
+
+    return result, depth
+
+def score_toplevel_move(move, board, max_depth=None, prune=True, budget=None, stats=None):
     """
     Entry Point to score the first move.
     """
@@ -74,179 +225,341 @@ def score_toplevel_move(move, board):
 	#	  calculate their scores dependence of the probability this will occur. (recursively)
 	# 3.) When you reach the leaf calculate the board score with your heuristic.
     
-    flat_board = board.flatten()
-    empty_tiles = count_empty_tiles(flat_board)
-    max_depth = calculate_max_depth(empty_tiles, MAX_DEPTH)
-    print("Depth: %d" % max_depth)
+    if max_depth is None:
+        empty_tiles = count_empty_tiles(board)
+        max_depth = calculate_max_depth(empty_tiles, MAX_DEPTH)
 
-    return score_max_node(move, board, 0, max_depth)
+    return score_max_node(move, board, 0, int(max_depth), 1.0, PROBABILITY_CUTOFF, bool(prune), 0.0, TABLE.entries, TABLE.counters, HEURISTIC, budget, stats)
 
-@jit(float64(float32,uint32[:,:],uint8,uint8))
-def score_chance_node(chance, board, depth, max_depth):
+def score_toplevel_moves(board, max_depth, max_nodes=None, stats=None, stop=None, prune=None):
     """
-    Chance node
+    Score all first moves. Every move is a task, or with SPLIT_CHANCE_NODES and
+    a pool every chance node of the first level. The first moves are never cut,
+    prune (default: BOUND_PRUNING) only applies below them.
+    With max_nodes the search is stopped after that many chance nodes,
+    once the event stop is set before the next task.
+    Returns: (list of scores or None if the search was stopped, chance nodes used)
     """
-    score = 0
-    for m in MOVES:
-        if m != DOWN:
-            score += score_max_node(m, board, depth, max_depth)
+    if prune is None:
+        prune = BOUND_PRUNING
+    result = [0.0] * len(MOVES)
+    moves = []
+    tasks = []
+    if POOL is not None and SPLIT_CHANCE_NODES:
+        for move in MOVES:
+            newboard = np.uint64(execute_move(move, board))
+            if board_equals(board, newboard):
+                continue
+            if max_depth <= 1:
+                result[move] = calculate_score(newboard, HEURISTIC)
+                continue
+            empty_tiles = count_empty_tiles(newboard)
+            for pos in range(16):
+                if bitboard.get_tile(newboard, pos) != 0:
+                    continue
+                for rank, chance in ((1, 0.9), (2, 0.1)):
+                    moves.append(move)
+                    tasks.append((score_chance_task, (chance / empty_tiles, bitboard.set_tile(newboard, pos, rank), 1, max_depth, prune)))
+    else:
+        for move in MOVES:
+            moves.append(move)
+            tasks.append((score_toplevel_move, (move, board, max_depth, prune)))
+
+    results, nodes = run_tasks(tasks, max_nodes, stop)
+    if stats is not None:
+        for move, (_, _, counters, seconds) in zip(moves, results):
+            stats.add_task(move, counters, seconds)
+    if len(results) < len(tasks) or any(score is None for score, _, _, _ in results):
+        return None, nodes
+
+    for move, (score, _, _, _), (func, args) in zip(moves, results, tasks):
+        if func is score_chance_task:
+            # the expectation over the new tiles like score_max_node
+            result[move] += args[0] * score
+        else:
+            result[move] = max(score, 0.0)
 
-    # Use DOWN only if neccessary
-    if score == 0:
-        score += score_max_node(DOWN, board, depth, max_depth) * 0.5
+    return result, nodes
 
-    return score * chance
+def run_tasks(tasks, max_nodes=None, stop=None):
+    """
+    Run search tasks, in the pool if one is running. In the pool the tasks run in
+    parallel, so each one gets its share of the node budget for one worker.
+    Returns: (list of worker_task results, chance nodes used)
+    """
+    if POOL is None:
+        results = []
+        nodes = 0
+        for func, args in tasks:
+            if stop is not None and stop.is_set():
+                break
+            nodes_left = None if max_nodes is None else max_nodes - nodes
+            results.append(worker_task((TABLE.generation, func, args, nodes_left, COLLECT_STATS)))
+            nodes += results[-1][1]
+            if results[-1][0] is None:
+                break
+        return results, nodes
+
+    if stop is not None and stop.is_set():
+        return [], 0
+    task_nodes = None
+    if max_nodes is not None and tasks:
+        task_nodes = max(1, max_nodes * min(len(tasks), WORKERS) // len(tasks))
+
+    results = POOL.map(worker_task, [(TABLE.generation, func, args, task_nodes, COLLECT_STATS) for func, args in tasks])
+    return results, sum(used for _, used, _, _ in results)
+
+@njit(cache=True, nogil=True)
+def score_chance_node(prob, board, depth, max_depth, cutoff, prune, table, counters, heuristic, budget, stats):
+    """
+    Chance node, the board with a new tile which is reached with the probability
+    prob. The score is the one of the best move and is stored in the transposition
+    table together with the remaining depth, not with prob: with a cutoff above 0
+    the score depends on the path which stored it first.
+    With prune the moves are searched best first by their static evaluation, and
+    a move which can't beat the best one so far is cut. Only worse moves are cut,
+    the score is the same as without prune if cutoff is 0. With a cutoff the
+    other order of the search can change the stored scores a little.
+    budget is None or an array with the number of chance nodes left, once it is
+    negative the search returns without storing anything.
+    stats is None or the counters of searchstats.
+    """
+    if budget is not None:
+        budget[0] -= 1
+        if budget[0] < 0:
+            return 0.0
+
+    # mirror images of the board which score the same share an entry
+    key = symmetry.canonical_board(board, heuristic[evaluation.SYMMETRIES])
+    found, score = transposition.lookup(table, counters, key, max_depth - depth)
+    if found:
+        if stats is not None:
+            stats[searchstats.CACHE_HITS] += 1
+        return score
+
+    if stats is not None:
+        stats[searchstats.CHANCE_NODES] += 1
+
+    moves = (UP, DOWN, LEFT, RIGHT)
+    # the moves of the last level are leaves, nothing to cut
+    if prune and depth + 1 < max_depth:
+        moves = order_moves(board, heuristic)
+
+    score = 0.0
+    for m in moves:
+        score = max(score, score_max_node(m, board, depth, max_depth, prob, cutoff, prune, score, table, counters, heuristic, budget, stats))
+
+    if budget is not None:
+        if budget[0] < 0:
+            return 0.0
+
+    transposition.store(table, counters, key, max_depth - depth, score)
+    return score
 
-@jit(float64(uint8,uint32[:,:],uint8,uint8))
-def score_max_node(move, board, depth, max_depth):
+@njit(cache=True, nogil=True, inline='always')
+def score_max_node(move, board, depth, max_depth, prob, cutoff, prune, alpha, table, counters, heuristic, budget, stats):
     """
-    Max node
+    Max node, the expected score of a move over all new tiles: a 2 with
+    probability 0.9 or a 4 with 0.1 on every empty tile. Boards which are
+    reached with a probability below cutoff are evaluated like leaves.
+    alpha is the score of the best sibling. With prune the search stops once
+    the expectation can't exceed it, the result is then an upper bound <= alpha.
+    It is inlined into score_chance_node, numba can't load cached
+    functions which call each other recursively.
     """
     newboard = execute_move(move, board)
 
-    if board_equals(board,newboard):
-        return 0
+    if board_equals(board, newboard):
+        return 0.0
 
-    flat_board = newboard.flatten()
-    # empty_tiles = count_empty_tiles(flat_board)
-    # recalculate max_depth to allow for lowering it for deeper nodes
-    # max_depth = calculate_max_depth(empty_tiles, max_depth)
     depth += 1
-    score = 0
 
     if depth >= max_depth:
-        return calculate_score(flat_board)
-
-    empty_tiles_pos = []
-    for i, row in enumerate(newboard):
-        for j, number in enumerate(row):
-            if number == 0:
-                empty_tiles_pos.append((j,i))
-
-    # limit the number of tiles used for further traversal
-    if len(empty_tiles_pos) > MAX_NEW_BRANCHES:
-        step = math.floor(len(empty_tiles_pos) / MAX_NEW_BRANCHES)
-        empty_tiles_pos = empty_tiles_pos[::step]
-
-    for pos in empty_tiles_pos:
-        x = pos[0]
-        y = pos[1]
-
+        if stats is not None:
+            stats[searchstats.LEAVES] += 1
+        return calculate_score(newboard, heuristic)
+
+    if prob < cutoff:
+        if stats is not None:
+            stats[searchstats.PRUNED] += 1
+        return calculate_score(newboard, heuristic)
+
+    if stats is not None:
+        stats[searchstats.MAX_NODES] += 1
+
+    empty_tiles = count_empty_tiles(newboard)
+    bound = np.inf
+    if prune and alpha > 0.0 and max_depth - depth <= BOUND_MOVES:
+        bound = evaluation.upper_bound(newboard, max_depth - depth, heuristic)
+
+    score = 0.0
+    left = empty_tiles
+    for pos in range(16):
+        if bitboard.get_tile(newboard, pos) != 0:
+            continue
         # create chance nodes
-        newboard[y][x] = 2
-        chance_one = score_chance_node(0.9, newboard, depth, max_depth)
-        chance_two = 0
-        if chance_one == 0:
-            newboard[y][x] = 4
-            chance_two = score_chance_node(0.1, newboard, depth, max_depth)
-
-        # maximize score
-        score = max(score, chance_one, 0)
-
-    return score
+        score += 0.9 * score_chance_node(prob * 0.9 / empty_tiles, bitboard.set_tile(newboard, pos, 1), depth, max_depth, cutoff, prune, table, counters, heuristic, budget, stats)
+        score += 0.1 * score_chance_node(prob * 0.1 / empty_tiles, bitboard.set_tile(newboard, pos, 2), depth, max_depth, cutoff, prune, table, counters, heuristic, budget, stats)
+        left -= 1
+        if left > 0 and score + left * bound <= alpha * empty_tiles:
+            if stats is not None:
+                stats[searchstats.CUTS] += 1
+            return (score + left * bound) / empty_tiles
+
+    return score / empty_tiles
+
+@njit(cache=True, nogil=True)
+def order_moves(board, heuristic):
+    """
+    The moves sorted by the static evaluation of the board after them, the best
+    first. Moves which don't change the board come last.
+    """
+    m0, m1, m2, m3 = UP, DOWN, LEFT, RIGHT
+    s0, s1, s2, s3 = _move_value(m0, board, heuristic), _move_value(m1, board, heuristic), _move_value(m2, board, heuristic), _move_value(m3, board, heuristic)
+    # sorting network for 4 values
+    if s0 < s1:
+        s0, s1, m0, m1 = s1, s0, m1, m0
+    if s2 < s3:
+        s2, s3, m2, m3 = s3, s2, m3, m2
+    if s0 < s2:
+        s0, s2, m0, m2 = s2, s0, m2, m0
+    if s1 < s3:
+        s1, s3, m1, m3 = s3, s1, m3, m1
+    if s1 < s2:
+        s1, s2, m1, m2 = s2, s1, m2, m1
+    return m0, m1, m2, m3
+
+@njit(cache=True, nogil=True)
+def _move_value(move, board, heuristic):
+    newboard = execute_move(move, board)
+    if board_equals(board, newboard):
+        return -1.0
+    return calculate_score(newboard, heuristic)
 
-@jit(nopython=True)
-def calculate_score(flat_board):
+@njit(cache=True)
+def calculate_score(board, heuristic):
     """
     Calculate the score of the board based on value of tiles and number of empty tiles
     """
-    tile_score = 0
-    empty_tiles = 0
-    for i, value in enumerate(flat_board):
-        if value == 0:
-            empty_tiles += 1
-        else:
-            tile_score += value ** 2 * TILE_WEIGHTS_FLAT[i]
-
-    return tile_score * empty_tiles
-    # return tile_score
+    return evaluation.evaluate(board, heuristic)
 
-    
-def calculate_penalty(board):
+def set_heuristic(weights='snake', monotonicity=0, smoothness=0, empty=0):
     """
-    Calculate penalty based on the difference between the optimal board and the current one
-    The optimal board is a snake pattern e.g. [8 7 6 5 1 2 3 4 0 0 0 0 ... ]
+    Rebuild the evaluation tables. Stored search results are dropped as they
+    were scored with the old tables.
     """
-    #  TODO fix or remove this function
-
-    # flat_board = list(itertools.chain.from_iterable(board))
-    flat_board = board.flatten()
-    tile_score = sum(flat_board)
-
-    optimal_board = flat_board.copy()
-    optimal_board = sorted(optimal_board, reverse=True)
-
-    for i in range(4, len(optimal_board) - 1, 4):
-        # reverse every second "row" to get the snake patterns
-        tmp = optimal_board[i]
-        optimal_board[i] = optimal_board[i + 3]
-        optimal_board[i + 3] = tmp
-
-        tmp = optimal_board[i + 1]
-        optimal_board[i + 1] = optimal_board[i + 2]
-        optimal_board[i + 2] = tmp
-
-    # Find mismatched numbers and add them as penalty to the score
-    empty_tiles = 1
-    penalty = 1
-    for i, v in enumerate(flat_board):
-        if v == 0:
-            empty_tiles += 1
-        if v != optimal_board[i] and v > 0:
-            penalty += v * 2 # math.log(v)
-
-    # print (penalty)
-    # print (optimal_board)
-    score = tile_score * empty_tiles
-
-    # print('penalty: %d' % (penalty))
-    # print('score: %d' % (score))
-
-    # print(optimal_board)
-
-    return penalty
-
-@jit(nopython=True)     
-def count_empty_tiles(flat_board):
-    empty_tiles = 0
-    for value in flat_board:
-        if value == 0:
-            empty_tiles += 1
-    return empty_tiles
-
-@jit(nopython=True)
+    global TILE_WEIGHTS, MONOTONICITY_WEIGHT, SMOOTHNESS_WEIGHT, EMPTY_WEIGHT, HEURISTIC
+    TILE_WEIGHTS = WEIGHT_SETS[weights] if isinstance(weights, str) else weights
+    MONOTONICITY_WEIGHT = monotonicity
+    SMOOTHNESS_WEIGHT = smoothness
+    EMPTY_WEIGHT = empty
+    HEURISTIC = evaluation.build_tables(TILE_WEIGHTS, MONOTONICITY_WEIGHT, SMOOTHNESS_WEIGHT, EMPTY_WEIGHT)
+    TABLE.clear()
+
+@njit(cache=True)
+def count_empty_tiles(board):
+    return bitboard.count_empty_tiles(board)
+
+@njit(cache=True)
 def calculate_max_depth(empty_tiles, max_depth):
     empty_tiles = max(empty_tiles, 1)
     depth = math.floor(MAX_DEPTH / (empty_tiles/2) + 1)
     return max(depth, MIN_DEPTH) if depth <= max_depth else max_depth
 
+@njit(cache=True)
 def execute_move(move, board):
     """
     move and return the grid without a new random tile
 	It won't affect the state of the game in the browser.
     """
+    return bitboard.execute_move(move, board)
 
-    if move == UP:
-        return game.merge_up(board)
-    elif move == DOWN:
-        return game.merge_down(board)
-    elif move == LEFT:
-        return game.merge_left(board)
-    elif move == RIGHT:
-        return game.merge_right(board)
-    else:
-        sys.exit("No valid move")
-
-@jit(nopython=True)     
+@njit(cache=True)
 def board_equals(board, newboard):
     """
     Check if two boards are equal
     """
-    return  (newboard == board).all()  
-    
-def func_star(a_b):
+    return newboard == board
+
+def score_chance_task(prob, board, depth, max_depth, prune=True, budget=None, stats=None):
+    return score_chance_node(float(prob), np.uint64(board), int(depth), int(max_depth), PROBABILITY_CUTOFF, bool(prune), TABLE.entries, TABLE.counters, HEURISTIC, budget, stats)
+
+def start_pool(workers, split_chance_nodes=False):
+    """
+    Start the worker processes used by find_best_move. Every worker keeps its own
+    transposition table for the whole session.
+    """
+    global POOL, WORKERS, SPLIT_CHANCE_NODES
+    stop_pool()
+    WORKERS = workers
+    # compile before the first move, and before forking as the workers would
+    # all compile and write the numba cache at once
+    warmup()
+    if workers > 1:
+        POOL = Pool(workers)
+    SPLIT_CHANCE_NODES = split_chance_nodes
+
+def warmup():
+    """
+    Compile the search functions with the argument types used by find_best_move.
+    They are cached on disk, after the first run they are only loaded.
+    Raises RuntimeError if a function isn't compiled in nopython mode, see check_compiled()
+    """
+    board = np.uint64(bitboard.to_bitboard([[2, 4, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 2]]))
+    budget = np.array([UNLIMITED_NODES], dtype=np.int64)
+    counters = searchstats.new_counters() if COLLECT_STATS else None
+    calculate_max_depth(count_empty_tiles(board), MAX_DEPTH)
+    board_equals(board, np.uint64(execute_move(UP, board)))
+    calculate_score(board, HEURISTIC)
+    for b in (None, budget):
+        score_toplevel_move(UP, board, MIN_DEPTH, True, b, counters)
+        score_chance_task(0.9, board, 1, MIN_DEPTH, True, b, counters)
+    check_compiled()
+
+def check_compiled():
+    """
+    Make sure every compiled function of the search runs in nopython mode and
+    is cached on disk. Object mode would be orders of magnitude slower.
+    Returns: (functions loaded from the disk cache, functions compiled by this process)
+    """
+    loaded = compiled = 0
+    for module in (bitboard, evaluation, symmetry, transposition, sys.modules[__name__]):
+        for name, func in sorted(vars(module).items()):
+            if not isinstance(func, Dispatcher):
+                continue
+            if not func.targetoptions.get('nopython') or any(cres.objectmode for cres in func.overloads.values()):
+                raise RuntimeError("%s.%s is compiled in object mode" % (module.__name__, name))
+            if func.stats.cache_path is None:
+                raise RuntimeError("%s.%s isn't cached on disk" % (module.__name__, name))
+            loaded += sum(func.stats.cache_hits.values())
+            compiled += sum(func.stats.cache_misses.values())
+    return loaded, compiled
+
+def stop_pool():
+    global POOL
+    if POOL is not None:
+        POOL.close()
+        POOL.join()
+        POOL = None
+
+def worker_task(task):
     """
-	Helper Method to split the programm in more processes.
-	Needed to handle more than one parameter.
+    Run a search function, in a pool worker or in the main process. A worker uses
+    the turn of the main process so its transposition table ages the same way.
+    Returns: (score or None if the node budget ran out, chance nodes used,
+              search counters or None, seconds)
     """
-    return score_toplevel_move (*a_b)
\ No newline at end of file
+    generation, func, args, max_nodes, collect_stats = task
+    TABLE.generation = generation
+    budget = None if max_nodes is None else np.array([max_nodes], dtype=np.int64)
+    counters = searchstats.new_counters() if collect_stats else None
+
+    start = time.time()
+    score = func(*args, budget=budget, stats=counters)
+    seconds = time.time() - start
+
+    if budget is None:
+        return score, 0, counters, seconds
+    elif budget[0] < 0:
+        return None, max_nodes, counters, seconds
+    return score, max_nodes - budget[0], counters, seconds
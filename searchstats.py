@@ -0,0 +1,97 @@
+# -*- coding: UTF-8 -*-
+import numpy as np
+
+# Author:      chrn
+# Description: Statistics of the expectimax search. The search kernels count into a small
+#              array which is only passed when statistics are enabled, otherwise numba
+#              compiles the counting away.
+
+# indices of the counters filled by the search
+MAX_NODES, CHANCE_NODES, LEAVES, PRUNED, CACHE_HITS, CUTS = range(6)
+COUNTER_NAMES = ('max_nodes', 'chance_nodes', 'leaves', 'pruned', 'cache_hits', 'cuts')
+
+def new_counters():
+    return np.zeros(len(COUNTER_NAMES), dtype=np.int64)
+
+
+class SearchStats(object):
+    ''' Statistics of one search, or of many if they are added together.
+
+    max_nodes and chance_nodes count the expanded nodes, leaves the evaluated boards,
+    pruned the boards evaluated early because of searchai.PROBABILITY_CUTOFF,
+    cache_hits the transposition table hits and cuts the moves stopped by
+    searchai.BOUND_PRUNING. The counters stay 0 unless searchai.COLLECT_STATS is set. '''
+
+    def __init__(self):
+        self.moves = 0
+        self.counters = new_counters()
+        self.depths = {}
+        self.seconds = 0.0
+        # score of the best move, of the last search if several were added
+        self.value = 0.0
+        # searches answered by searchai.MOVE_CACHE
+        self.move_cache_hits = 0
+        # time spent on every first move, UP, DOWN, LEFT, RIGHT
+        self.move_seconds = [0.0] * 4
+        # searches checked by searchai.VERIFY_PRUNING and those where the full search found another move
+        self.pruning_checks = 0
+        self.pruning_mismatches = 0
+
+    def __getattr__(self, name):
+        if name in COUNTER_NAMES:
+            return int(self.counters[COUNTER_NAMES.index(name)])
+        raise AttributeError(name)
+
+    @property
+    def depth(self):
+        ''' Depth of the search, the largest one if several searches were added. '''
+        return max(self.depths) if self.depths else 0
+
+    def add_task(self, move, counters, seconds):
+        if counters is not None:
+            self.counters += counters
+        self.move_seconds[move] += seconds
+
+    def finish(self, depth, seconds, value):
+        self.moves = 1
+        self.depths = {depth: 1}
+        self.seconds = seconds
+        self.value = value
+
+    def verify_pruning(self, same_move):
+        self.pruning_checks += 1
+        if not same_move:
+            self.pruning_mismatches += 1
+
+    def add(self, other):
+        ''' Add the statistics of another search, e.g. to sum up a game. '''
+        self.moves += other.moves
+        self.counters += other.counters
+        for depth, moves in other.depths.items():
+            self.depths[depth] = self.depths.get(depth, 0) + moves
+        self.seconds += other.seconds
+        self.value = other.value
+        self.move_cache_hits += other.move_cache_hits
+        self.move_seconds = [a + b for a, b in zip(self.move_seconds, other.move_seconds)]
+        self.pruning_checks += other.pruning_checks
+        self.pruning_mismatches += other.pruning_mismatches
+
+    def as_dict(self):
+        result = dict((name, int(value)) for name, value in zip(COUNTER_NAMES, self.counters))
+        result.update({'moves': self.moves, 'depths': dict(self.depths), 'seconds': self.seconds,
+                       'value': self.value, 'move_cache_hits': self.move_cache_hits,
+                       'move_seconds': list(self.move_seconds), 'pruning_checks': self.pruning_checks,
+                       'pruning_mismatches': self.pruning_mismatches})
+        return result
+
+    def __str__(self):
+        nodes = self.max_nodes + self.chance_nodes
+        result = ("Moves: %d, depths: %s, time: %.3fs, nodes: %d (%d max, %d chance, %.0f/s), "
+                  "leaves: %d, pruned: %d, cuts: %d, cache hits: %d, move cache hits: %d") % (
+            self.moves, ' '.join('%d:%d' % item for item in sorted(self.depths.items())), self.seconds,
+            nodes, self.max_nodes, self.chance_nodes, nodes / self.seconds if self.seconds > 0 else 0,
+            self.leaves, self.pruned, self.cuts, self.cache_hits, self.move_cache_hits)
+        if self.pruning_checks:
+            result += ", pruning verified: %d of %d moves the same" % (
+                self.pruning_checks - self.pruning_mismatches, self.pruning_checks)
+        return result
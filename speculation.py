@@ -0,0 +1,117 @@
+# -*- coding: UTF-8 -*-
+import threading
+import numpy as np
+
+import bitboard
+import searchai
+
+# Author:      chrn
+# Description: Search the next turn while the browser is busy with the current move.
+#              After a move is sent the boards which can follow it, one for every
+#              possible new tile, are searched in a background thread. If the game
+#              reaches one of them the move is ready without searching.
+
+# upper limit of the boards searched ahead, a board has at most 15 empty tiles
+MAX_BOARDS = 30
+
+
+def successors(board, move):
+    """
+    Boards which can follow the move, the most probable first: a 2 appears with
+    probability 0.9 on any empty tile, a 4 with probability 0.1.
+
+    >>> board = bitboard.to_bitboard([[2, 2, 4, 8], [4, 8, 16, 32], [2, 4, 8, 2], [4, 2, 4, 0]])
+    >>> [bitboard.to_board(b)[0].tolist() for b in successors(board, 2)]
+    [[4, 4, 8, 2], [4, 4, 8, 0], [4, 4, 8, 4], [4, 4, 8, 0]]
+    """
+    board = np.uint64(board)
+    newboard = np.uint64(bitboard.execute_move(move, board))
+    if newboard == board:
+        return []
+    empty = [pos for pos in range(16) if bitboard.get_tile(newboard, pos) == 0]
+    return [int(bitboard.set_tile(newboard, pos, rank)) for rank in (1, 2) for pos in empty]
+
+
+class Speculator(object):
+    ''' Search the boards which can follow a move in a background thread.
+
+    The search isn't thread safe, the thread is stopped before the next search
+    of the game. If the game reached the board which is searched right now the
+    search is finished, otherwise it is stopped after its current task. '''
+
+    def __init__(self, max_boards=MAX_BOARDS):
+        self.max_boards = max_boards
+        self.results = {}
+        self.thread = None
+        self.current = None
+        self.stop = threading.Event()
+        self.hits = 0
+        self.misses = 0
+        self.searched = 0
+
+    def start(self, board, move):
+        ''' Start to search the boards which follow move on the packed board. '''
+        self.cancel()
+        self.results = {}
+        self.stop.clear()
+        boards = successors(board, move)[:self.max_boards]
+        # all boards belong to the next turn, the table is only aged once for them
+        searchai.TABLE.new_search()
+        self.thread = threading.Thread(target=self._run, args=(boards,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, boards):
+        for board in boards:
+            if self.stop.is_set():
+                break
+            self.current = board
+            move, stats = searchai.search(bitboard.to_board(board), stop=self.stop, new_turn=False)
+            # a stopped search may have a weaker move, it is dropped
+            if not self.stop.is_set():
+                self.results[board] = move, stats
+                self.searched += 1
+        self.current = None
+
+    def cancel(self, board=None):
+        ''' Stop the background search, unless it is searching board. '''
+        if self.thread is not None:
+            if board is None or self.current != board:
+                self.stop.set()
+            else:
+                self.stop_after(board)
+            self.thread.join()
+            self.thread = None
+
+    def stop_after(self, board):
+        # wait for the board, the thread may already be at the next one
+        while self.thread.is_alive() and board not in self.results and self.current == board:
+            self.thread.join(0.001)
+        self.stop.set()
+
+    def get_move(self, board):
+        """
+        Stop the background search and return the move found for the packed board,
+        or None if it wasn't searched.
+        """
+        self.cancel(board)
+        result = self.results.pop(board, None)
+        self.results = {}
+        if result is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        move, stats = result
+        if searchai.STATS_HOOK is not None:
+            searchai.STATS_HOOK(stats)
+        return move
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups else 0.0
+
+    def __str__(self):
+        return "Speculation: %d hits, %d misses (%.1f%% hit rate), %d boards searched ahead" % (
+            self.hits, self.misses, self.hit_rate * 100, self.searched)
@@ -0,0 +1,161 @@
+# -*- coding: UTF-8 -*-
+import numpy as np
+from numba import njit
+
+import bitboard
+from util import UP, DOWN, LEFT, RIGHT
+
+# Author:      chrn
+# Description: The 8 symmetries of the board, its rotations and mirror images. Boards which
+#              are images of each other are stored once in the caches: every board is mapped
+#              to its canonical form, the smallest packed image under the symmetries of the
+#              heuristic, and moves are mapped along with it.
+
+# A transform is a combination of these bits, applied in this order:
+# mirror left-right, mirror top-bottom, transpose. 0 leaves the board as it is.
+IDENTITY = 0
+MIRROR_H, MIRROR_V, TRANSPOSE = 1, 2, 4
+TRANSFORMS = 8
+
+
+@njit(cache=True)
+def mirror_h(board):
+    """
+    Mirror the board left-right, the nibbles of every row are reversed
+    """
+    return (((board & np.uint64(0x000F000F000F000F)) << np.uint64(12)) |
+            ((board & np.uint64(0x00F000F000F000F0)) << np.uint64(4)) |
+            ((board & np.uint64(0x0F000F000F000F00)) >> np.uint64(4)) |
+            ((board & np.uint64(0xF000F000F000F000)) >> np.uint64(12)))
+
+@njit(cache=True)
+def mirror_v(board):
+    """
+    Mirror the board top-bottom, the order of the rows is reversed
+    """
+    return (((board & np.uint64(0x000000000000FFFF)) << np.uint64(48)) |
+            ((board & np.uint64(0x00000000FFFF0000)) << np.uint64(16)) |
+            ((board & np.uint64(0x0000FFFF00000000)) >> np.uint64(16)) |
+            ((board & np.uint64(0xFFFF000000000000)) >> np.uint64(48)))
+
+@njit(cache=True)
+def transform(board, t):
+    """
+    Image of the packed board under the transform t
+    >>> hex(transform(np.uint64(0x21), MIRROR_H))
+    '0x1200'
+    >>> hex(transform(np.uint64(0x21), TRANSPOSE | MIRROR_V))
+    '0x20001000'
+    """
+    if t & MIRROR_H:
+        board = mirror_h(board)
+    if t & MIRROR_V:
+        board = mirror_v(board)
+    if t & TRANSPOSE:
+        board = bitboard.transpose(board)
+    return board
+
+@njit(cache=True)
+def canonical(board, transforms):
+    """
+    The smallest image of the board under the transforms and the transform
+    which gives it. transforms has to contain IDENTITY.
+    >>> transforms = np.arange(TRANSFORMS)
+    >>> [hex(canonical(transform(np.uint64(0x21), t), transforms)[0]) for t in (0, 3, 5)]
+    ['0x21', '0x21', '0x21']
+    """
+    best = board
+    best_transform = IDENTITY
+    for t in transforms:
+        image = transform(board, t)
+        if image < best:
+            best = image
+            best_transform = t
+    return best, best_transform
+
+@njit(cache=True)
+def canonical_board(board, transforms):
+    """
+    The smallest image of the board, the key of the board in the caches
+    """
+    best = board
+    for t in transforms:
+        best = min(best, transform(board, t))
+    return best
+
+
+def transform_array(array, t):
+    """
+    Image of a 4x4 array, e.g. an unpacked board, under the transform t
+    """
+    array = np.asarray(array)
+    if t & MIRROR_H:
+        array = array[:, ::-1]
+    if t & MIRROR_V:
+        array = array[::-1, :]
+    if t & TRANSPOSE:
+        array = array.T
+    return array
+
+def transform_weights(weights, t):
+    """
+    Tile weights which score the image of a board under t like weights score the board
+    """
+    return transform_array(np.asarray(weights, dtype=np.float64).reshape(4, 4), t)
+
+def stabilizer(weights):
+    """
+    The transforms which don't change the tile weights. The heuristic gives the
+    same score for all images of a board under them, so they share one cache entry.
+    >>> import searchai
+    >>> stabilizer(searchai.SNAKE).tolist(), stabilizer(searchai.CORNER).tolist()
+    ([0], [0, 4])
+    """
+    weights = transform_weights(weights, IDENTITY)
+    return np.array([t for t in range(TRANSFORMS) if np.array_equal(transform_weights(weights, t), weights)], dtype=np.int64)
+
+def _build_move_tables():
+    """
+    The move on the image under t which gives the image of the move on the board.
+    A mirror swaps the two moves along its axis, transpose swaps the axes.
+    """
+    moves = np.zeros((TRANSFORMS, 4), dtype=np.int64)
+    inverse = np.zeros(TRANSFORMS, dtype=np.int64)
+    board = np.uint64(0x0123456789ABCDEF)
+    for t in range(TRANSFORMS):
+        for move in (UP, DOWN, LEFT, RIGHT):
+            m = move
+            if t & MIRROR_H:
+                m = {LEFT: RIGHT, RIGHT: LEFT}.get(m, m)
+            if t & MIRROR_V:
+                m = {UP: DOWN, DOWN: UP}.get(m, m)
+            if t & TRANSPOSE:
+                m = {UP: LEFT, LEFT: UP, DOWN: RIGHT, RIGHT: DOWN}[m]
+            moves[t, move] = m
+        inverse[t] = [u for u in range(TRANSFORMS) if transform(np.uint64(transform(board, t)), u) == board][0]
+    return moves, inverse
+
+MOVE_TABLE, INVERSE = _build_move_tables()
+
+def transform_move(move, t):
+    """
+    Map a move on a board to the move on its image under t. A best move stays the
+    best move: searching the image gives the mapped move of the board.
+    >>> import searchai
+    >>> searchai.set_heuristic('corner')
+    >>> board = bitboard.to_board(0x1000320001225433)
+    >>> image = bitboard.to_board(transform(np.uint64(0x1000320001225433), TRANSPOSE))
+    >>> move = searchai.find_best_move(board, 3)
+    >>> move, searchai.find_best_move(image, 3) == transform_move(move, TRANSPOSE)
+    (2, True)
+    >>> searchai.set_heuristic('snake')
+    """
+    return int(MOVE_TABLE[t, move])
+
+def inverse(t):
+    """
+    The transform which undoes t
+    >>> [inverse(t) for t in range(TRANSFORMS)]
+    [0, 1, 2, 3, 4, 6, 5, 7]
+    """
+    return int(INVERSE[t])
@@ -0,0 +1,132 @@
+# -*- coding: UTF-8 -*-
+import numpy as np
+from numba import njit
+
+# Author:      chrn
+# Description: Bounded transposition table for the expectimax search. Positions are
+#              stored by packed board and remaining search depth in 2-way buckets.
+#              Entries from earlier turns are kept until their slot is needed.
+
+ENTRY_DTYPE = np.dtype([
+    ('key', np.uint64),     # packed board
+    ('value', np.float64),  # score of the position
+    ('depth', np.uint8),    # remaining depth, 0 marks an empty slot
+    ('age', np.uint8),      # generation (turn) of the last write
+])
+
+# indices into the counters array
+GENERATION, HITS, MISSES, EVICTIONS, STORES = range(5)
+
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+DEPTH_MULTIPLIER = np.uint64(0xC2B2AE3D27D4EB4F)
+
+
+class TranspositionTable(object):
+    ''' Fixed size cache of search results which is kept between turns. '''
+
+    def __init__(self, max_memory_mb=64):
+        # use the largest power of two which fits in the memory cap
+        size = 2
+        while size * 2 * ENTRY_DTYPE.itemsize <= max_memory_mb * 1024 * 1024:
+            size *= 2
+        self.entries = np.zeros(size, dtype=ENTRY_DTYPE)
+        self.counters = np.zeros(5, dtype=np.int64)
+
+    def new_search(self):
+        ''' Start a new turn. Entries of older turns are evicted first. '''
+        self.counters[GENERATION] = (self.counters[GENERATION] + 1) % 256
+
+    @property
+    def generation(self):
+        return int(self.counters[GENERATION])
+
+    @generation.setter
+    def generation(self, generation):
+        self.counters[GENERATION] = generation
+
+    def clear(self):
+        self.entries[:] = 0
+        self.counters[:] = 0
+
+    @property
+    def hits(self):
+        return int(self.counters[HITS])
+
+    @property
+    def misses(self):
+        return int(self.counters[MISSES])
+
+    @property
+    def evictions(self):
+        return int(self.counters[EVICTIONS])
+
+    @property
+    def memory(self):
+        return self.entries.nbytes
+
+    def __len__(self):
+        return int(np.count_nonzero(self.entries['depth']))
+
+    def __repr__(self):
+        return "TranspositionTable(entries=%d/%d, hits=%d, misses=%d, evictions=%d)" % (
+            len(self), self.entries.shape[0], self.hits, self.misses, self.evictions)
+
+
+@njit(cache=True)
+def _bucket(entries, board, depth):
+    # fold the high half in first, the bits of the index only depend on lower bits of the key
+    h = ((board ^ (board >> np.uint64(32))) ^ (np.uint64(depth) * DEPTH_MULTIPLIER)) * HASH_MULTIPLIER
+    index = np.int64((h >> np.uint64(32)) & np.uint64(entries.shape[0] - 1))
+    return index & ~1
+
+@njit(cache=True)
+def lookup(entries, counters, board, depth):
+    """
+    Return (True, value) if the board was stored with the same remaining depth
+    """
+    index = _bucket(entries, board, depth)
+    for slot in range(index, index + 2):
+        entry = entries[slot]
+        if entry['key'] == board and entry['depth'] == depth:
+            # refresh the entry so it survives the next turn
+            entry['age'] = counters[GENERATION]
+            counters[HITS] += 1
+            return True, entry['value']
+
+    counters[MISSES] += 1
+    return False, 0.0
+
+@njit(cache=True)
+def store(entries, counters, board, depth, value):
+    """
+    Store the value of a board. Replace the entry of an older turn first,
+    then the one with less remaining depth as it is cheaper to recompute.
+    """
+    index = _bucket(entries, board, depth)
+    generation = counters[GENERATION]
+
+    victim = index
+    victim_priority = 1 << 16
+    for slot in range(index, index + 2):
+        entry = entries[slot]
+        if entry['depth'] == 0 or (entry['key'] == board and entry['depth'] == depth):
+            victim = slot
+            victim_priority = -1
+            break
+
+        priority = np.int64(entry['depth'])
+        if entry['age'] == generation:
+            priority += 256
+        if priority < victim_priority:
+            victim = slot
+            victim_priority = priority
+
+    if victim_priority >= 0:
+        counters[EVICTIONS] += 1
+
+    entry = entries[victim]
+    entry['key'] = board
+    entry['value'] = value
+    entry['depth'] = depth
+    entry['age'] = generation
+    counters[STORES] += 1
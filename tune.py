@@ -0,0 +1,219 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Author:      chrn
+# Description: Tune the weights of the AIs with self-play. CMA-ES proposes weights, every
+#              candidate plays the same seeded headless games in a pool of worker processes
+#              and the state of the optimiser is saved after every generation.
+
+from __future__ import print_function
+
+import os
+import json
+import math
+import time
+import random
+from multiprocessing import Pool
+
+import numpy as np
+
+import searchai
+import heuristicai
+from headlessctrl import Headless2048Control
+
+# constants of heuristicai which its rules read, OPTIMAL_POSITION_WEIGHT doesn't change any move
+HEURISTIC_PARAMS = ('THRESHOLD', 'BEST_MERGE_WEIGHT', 'FUTURE_MERGE_WEIGHT')
+
+
+class CMAES(object):
+    ''' Minimise a function with the covariance matrix adaptation evolution strategy.
+
+    The candidates of a generation are drawn from a random state seeded with the
+    generation, so a resumed run asks the same candidates. '''
+
+    def __init__(self, mean, sigma, popsize=None, seed=0):
+        n = len(mean)
+        self.n = n
+        self.seed = seed
+        self.popsize = popsize or 4 + int(3 * math.log(n))
+        self.mu = self.popsize // 2
+        weights = math.log(self.mu + 0.5) - np.log(np.arange(1, self.mu + 1))
+        self.weights = weights / weights.sum()
+        self.mueff = 1 / np.sum(self.weights ** 2)
+
+        # learning rates of the paths, the covariance matrix and the step size
+        self.cc = (4 + self.mueff / n) / (n + 4 + 2 * self.mueff / n)
+        self.cs = (self.mueff + 2) / (n + self.mueff + 5)
+        self.c1 = 2 / ((n + 1.3) ** 2 + self.mueff)
+        self.cmu = min(1 - self.c1, 2 * (self.mueff - 2 + 1 / self.mueff) / ((n + 2) ** 2 + self.mueff))
+        self.damps = 1 + 2 * max(0, math.sqrt((self.mueff - 1) / (n + 1)) - 1) + self.cs
+        self.chi_n = math.sqrt(n) * (1 - 1.0 / (4 * n) + 1.0 / (21 * n ** 2))
+
+        self.mean = np.array(mean, dtype=np.float64)
+        self.sigma = float(sigma)
+        self.C = np.eye(n)
+        self.pc = np.zeros(n)
+        self.ps = np.zeros(n)
+        self.generation = 0
+
+    def ask(self):
+        D2, B = np.linalg.eigh(self.C)
+        D = np.sqrt(np.maximum(D2, 1e-20))
+        z = np.random.RandomState(self.seed + self.generation).standard_normal((self.popsize, self.n))
+        return self.mean + self.sigma * (z * D).dot(B.T)
+
+    def tell(self, candidates, fitness):
+        ''' Update the distribution with the fitness (smaller is better) of the asked candidates. '''
+        order = np.argsort(fitness)
+        y = (candidates[order[:self.mu]] - self.mean) / self.sigma
+        y_mean = self.weights.dot(y)
+        self.mean = self.mean + self.sigma * y_mean
+
+        D2, B = np.linalg.eigh(self.C)
+        inv_sqrt = B.dot(np.diag(1 / np.sqrt(np.maximum(D2, 1e-20)))).dot(B.T)
+        self.ps = (1 - self.cs) * self.ps + math.sqrt(self.cs * (2 - self.cs) * self.mueff) * inv_sqrt.dot(y_mean)
+        norm = np.linalg.norm(self.ps) / math.sqrt(1 - (1 - self.cs) ** (2 * (self.generation + 1)))
+        hsig = float(norm / self.chi_n < 1.4 + 2.0 / (self.n + 1))
+        self.pc = (1 - self.cc) * self.pc + hsig * math.sqrt(self.cc * (2 - self.cc) * self.mueff) * y_mean
+
+        rank_one = np.outer(self.pc, self.pc) + (1 - hsig) * self.cc * (2 - self.cc) * self.C
+        rank_mu = (y.T * self.weights).dot(y)
+        self.C = (1 - self.c1 - self.cmu) * self.C + self.c1 * rank_one + self.cmu * rank_mu
+        self.C = (self.C + self.C.T) / 2
+        self.sigma *= math.exp((self.cs / self.damps) * (np.linalg.norm(self.ps) / self.chi_n - 1))
+        self.generation += 1
+
+    STATE = ('mean', 'sigma', 'C', 'pc', 'ps', 'generation', 'seed', 'popsize')
+
+    def state(self):
+        return dict((key, np.asarray(getattr(self, key)).tolist()) for key in self.STATE)
+
+    @classmethod
+    def from_state(cls, state):
+        es = cls(state['mean'], state['sigma'], state['popsize'], state['seed'])
+        es.C = np.array(state['C'])
+        es.pc = np.array(state['pc'])
+        es.ps = np.array(state['ps'])
+        es.generation = state['generation']
+        return es
+
+
+# The weights are tuned as log2 values, so they stay positive and are scaled evenly.
+
+def initial_params(engine):
+    if engine == 'search':
+        return np.log2(np.asarray(searchai.TILE_WEIGHTS, dtype=np.float64).ravel())
+    return np.log2([getattr(heuristicai, name) for name in HEURISTIC_PARAMS] + list(heuristicai.DIRECTION_WEIGHT))
+
+def describe_params(engine, params):
+    values = 2.0 ** np.asarray(params)
+    if engine == 'search':
+        return {'TILE_WEIGHTS': values.reshape(4, 4).round(4).tolist()}
+    result = dict((name, float(value)) for name, value in zip(HEURISTIC_PARAMS, values))
+    result['DIRECTION_WEIGHT'] = values[len(HEURISTIC_PARAMS):].round(4).tolist()
+    return result
+
+def set_params(engine, params):
+    ''' Use the weights in this process. The search gets new tables, nothing is recompiled. '''
+    values = 2.0 ** np.asarray(params)
+    if engine == 'search':
+        searchai.set_heuristic(values.reshape(4, 4).tolist())
+    else:
+        for name, value in zip(HEURISTIC_PARAMS, values):
+            setattr(heuristicai, name, value)
+        heuristicai.DIRECTION_WEIGHT = values[len(HEURISTIC_PARAMS):].tolist()
+
+
+def play_task(task):
+    ''' Play one seeded game with the weights in a worker. Returns the score. '''
+    engine, params, seed, depth = task
+    set_params(engine, params)
+    random.seed(seed)
+    gamectrl = Headless2048Control(seed)
+    while gamectrl.get_status() != 'ended':
+        if gamectrl.get_status() == 'won':
+            gamectrl.continue_game()
+        board = gamectrl.get_board()
+        if engine == 'search':
+            move = searchai.find_best_move(board, depth)
+        else:
+            move = heuristicai.find_best_move(board)
+        gamectrl.execute_move(move)
+    return gamectrl.get_score()
+
+
+def tune(engine, generations, games, depth, workers, checkpoint, sigma=0.5, popsize=None, seed=0):
+    state = None
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            state = json.load(f)
+        es = CMAES.from_state(state['cmaes'])
+        # a run is only continued with the settings it was started with
+        if state['engine'] != engine or es.seed != seed or es.n != len(initial_params(engine)):
+            raise ValueError("%s was written by a run of the %s engine with seed %d and %d parameters" % (
+                checkpoint, state['engine'], es.seed, es.n))
+        print("Resuming at generation %d" % es.generation)
+    else:
+        es = CMAES(initial_params(engine), sigma, popsize, seed)
+    best = state['best'] if state else None
+
+    if engine == 'search':
+        # compile before forking, see searchai.start_pool()
+        searchai.warmup()
+    pool = Pool(workers)
+    try:
+        while es.generation < generations:
+            start = time.time()
+            candidates = es.ask()
+            # common random numbers: all candidates of a generation play the same games
+            seeds = [seed + es.generation * games + i for i in range(games)]
+            tasks = [(engine, candidate.tolist(), s, depth) for candidate in candidates for s in seeds]
+            scores = np.array(pool.map(play_task, tasks)).reshape(len(candidates), games)
+            means = scores.mean(axis=1)
+
+            i = int(np.argmax(means))
+            print("Generation %d: best %.0f, mean %.0f, sigma %.3f, %.1fs" % (
+                es.generation + 1, means[i], means.mean(), es.sigma, time.time() - start))
+            if best is None or means[i] > best['score']:
+                best = {'score': float(means[i]), 'generation': es.generation + 1, 'params': candidates[i].tolist(),
+                        'weights': describe_params(engine, candidates[i])}
+            es.tell(candidates, -means)
+
+            if checkpoint:
+                with open(checkpoint + '.tmp', 'w') as f:
+                    json.dump({'engine': engine, 'cmaes': es.state(), 'best': best}, f)
+                os.rename(checkpoint + '.tmp', checkpoint)
+    finally:
+        pool.close()
+        pool.join()
+
+    return best, describe_params(engine, es.mean)
+
+def parse_args(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Tune the weights of the AIs with self-play and CMA-ES")
+    parser.add_argument('engine', choices=('search', 'heuristic'), help="Tune the TILE_WEIGHTS of the search or the constants of heuristicai.")
+    parser.add_argument('-g', '--generations', default=20, type=int)
+    parser.add_argument('-n', '--games', help="Games of every candidate, the same seeds for all of a generation.", default=8, type=int)
+    parser.add_argument('-d', '--depth', help="Search depth of the games.", default=2, type=int)
+    parser.add_argument('-w', '--workers', help="Worker processes (default: all cores).", default=os.cpu_count(), type=int)
+    parser.add_argument('-c', '--checkpoint', help="Save the state to this file after every generation and resume from it.")
+    parser.add_argument('--sigma', help="Initial step size, in log2 of the weights.", default=0.5, type=float)
+    parser.add_argument('--popsize', help="Candidates per generation.", type=int)
+    parser.add_argument('-s', '--seed', default=0, type=int)
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+    best, mean = tune(args.engine, args.generations, args.games, args.depth, args.workers,
+                      args.checkpoint, args.sigma, args.popsize, args.seed)
+    print("Best candidate: %.0f in generation %d" % (best['score'], best['generation']))
+    print(json.dumps(best['weights']))
+    print("Mean of the distribution:")
+    print(json.dumps(mean))
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    exit(main(sys.argv[1:]))